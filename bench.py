@@ -0,0 +1,410 @@
+"""
+Client-side timetric benchmarks. These don't talk to Timetric; run them with::
+
+    python bench.py [--json results.json] [name ...]
+
+to time the named benchmarks (or all of them), and compare the numbers from
+before and after a change. With ``--json`` the numbers are also saved to a
+file, so a run can be kept and compared against later.
+"""
+
+import datetime
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timetric
+from cStringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+BENCHMARKS = []
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+def timed(func, *args):
+    """
+    Call `func(*args)` and return the wall-clock time it took.
+    """
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+@benchmark
+def timestamps(n=100000):
+    """
+    Parse `n` timestamps of each common format with `_parse_timestamp` and
+    with `_TimestampParser`.
+    """
+    start = datetime.datetime(2009, 3, 11)
+    step = datetime.timedelta(seconds=10)
+    formats = {
+        'epoch': lambda dt: '%d' % time.mktime(dt.timetuple()),
+        'iso8601': lambda dt: dt.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'rfc2822': lambda dt: dt.strftime('%a, %d %b %Y %H:%M:%S +0000'),
+    }
+    results = {}
+    for (name, format) in sorted(formats.items()):
+        values = [format(start + step * i) for i in xrange(n)]
+        repeated = values[:n // 100] * 100
+        parser = timetric._TimestampParser()
+        results[name] = {
+            'dateutil': timed(map, timetric._parse_timestamp, values),
+            'fast': timed(map, parser, values),
+            'fast_repeated': timed(map, timetric._TimestampParser(), repeated),
+        }
+    return results
+
+class NullHttp(object):
+    """
+    Stands in for `httplib2.Http`, so only the client's own work is timed.
+    """
+    def request(self, url, method, body=None, headers=None):
+        return {'status': '204'}, ''
+
+@benchmark
+def request_overhead(n=100000):
+    """
+    Time `n` increment-sized POSTs through each auth type's `make_request`,
+    with the network taken out of the picture.
+    """
+    configs = {
+        'apitoken': {'authtype': 'apitoken', 'apitoken_key': 'key',
+                     'apitoken_secret': 'secret'},
+        'oauth': {'authtype': 'oauth', 'consumer_key': 'key',
+                  'consumer_secret': 'secret', 'oauth_token': 'token',
+                  'oauth_secret': 'secret'},
+    }
+    results = {}
+    for (name, config) in sorted(configs.items()):
+        try:
+            client = timetric.TimetricClient(config)
+        except ImportError:
+            continue
+        client.http = NullHttp()
+        url = client.series_url % 'bench'
+        elapsed = timed(lambda: [client.post(url, {'increment': '1'})
+                                 for i in xrange(n)])
+        results[name] = {'per_request_us': elapsed / n * 1e6}
+    return results
+
+@benchmark
+def concurrency(n=200, delay=0.02):
+    """
+    Fetch the latest value of `n` series from a local stand-in server that
+    takes `delay` seconds per request, at several concurrency limits.
+    """
+    from test import FakeTimetric
+    server = FakeTimetric(delay=delay)
+    for i in xrange(n):
+        server.series['s%s' % i] = [(1236735000.0, float(i))]
+    results = {}
+    try:
+        for limit in (1, 4, 16, 64):
+            client = timetric.AsyncTimetricClient(
+                {'authtype': 'apitoken', 'apitoken_key': 'key',
+                 'apitoken_secret': 'secret'},
+                max_concurrency=limit,
+            )
+            client.series_url = server.url + 'series/%s/'
+            elapsed = timed(lambda: [
+                f.result() for f in
+                [client.series('s%s' % i).latest() for i in xrange(n)]
+            ])
+            client.close()
+            results['limit_%02d' % limit] = {'requests_per_s': n / elapsed}
+    finally:
+        server.stop()
+    return results
+
+def _rows(size, start=1236735000):
+    return [(start + i * 10, float(i)) for i in xrange(size)]
+
+def _csv(rows):
+    return ''.join('%s,%s\n' % row for row in rows)
+
+def _measure(operation, requests, concurrency):
+    """
+    Call `operation(i)` for each of `requests` values of `i`, spread over
+    `concurrency` threads, and return the throughput and latencies.
+    """
+    latencies = []
+    lock = threading.Lock()
+    def work(indices):
+        mine = []
+        for i in indices:
+            start = time.time()
+            operation(i)
+            mine.append(time.time() - start)
+        with lock:
+            latencies.extend(mine)
+    threads = [threading.Thread(target=work, args=(range(t, requests, concurrency),))
+               for t in xrange(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'requests_per_s': requests / elapsed,
+        'latency_mean_ms': sum(latencies) / len(latencies) * 1e3,
+        'latency_p50_ms': latencies[len(latencies) // 2] * 1e3,
+        'latency_p95_ms': latencies[int(len(latencies) * 0.95)] * 1e3,
+        'latency_max_ms': latencies[-1] * 1e3,
+    }
+
+@benchmark
+def api(requests=50, sizes=(1, 100, 10000), concurrency=(1, 8)):
+    """
+    Time each client operation against a local stand-in server: `requests`
+    calls at each payload size (in rows) and concurrency level, the calls
+    spread over that many threads sharing one pooled client.
+    """
+    from test import FakeTimetric
+    server = FakeTimetric()
+    results = {}
+    try:
+        for threads in concurrency:
+            client = server.client(pool_size=threads)
+            series = client.series
+            server.series['scalar'] = []
+            results['update_scalar.c%s' % threads] = _measure(
+                lambda i: series('scalar').update(float(i)), requests, threads)
+            results['increment.c%s' % threads] = _measure(
+                lambda i: series('scalar').increment(1), requests, threads)
+            for size in sizes:
+                case = 'rows_%s.c%s' % (size, threads)
+                rows = _rows(size)
+                body = _csv(rows)
+                server.series['iterable'] = []
+                server.series['file'] = []
+                server.series['read'] = rows
+                results['update_iterable.' + case] = _measure(
+                    lambda i: series('iterable').update(rows), requests, threads)
+                results['update_file.' + case] = _measure(
+                    lambda i: series('file').update(StringIO(body)), requests, threads)
+                results['rewrite.' + case] = _measure(
+                    lambda i: series('iterable').rewrite(rows), requests, threads)
+                results['csv.' + case] = _measure(
+                    lambda i: series('read').csv(), requests, threads)
+                results['iter.' + case] = _measure(
+                    lambda i: list(series('read')), requests, threads)
+                results['create_series.' + case] = _measure(
+                    lambda i: client.create_series(rows, title='bench', caption='bench'),
+                    requests, threads)
+                server.series.clear()
+    finally:
+        server.stop()
+    return results
+
+@benchmark
+def compression(sizes=(1000, 10000, 100000), repeat=5):
+    """
+    Upload and stream back a random-walk series of each size (in rows)
+    through a local stand-in server, uncompressed and gzipped at several
+    levels, noting the body bytes on the wire, the client's time spent
+    compressing, and the time per request. The server's in-process too, so
+    its time spent gzipping downloads is counted.
+    """
+    import random
+    from test import FakeTimetric
+    server = FakeTimetric()
+    results = {}
+    try:
+        for size in sizes:
+            value = 100.0
+            rows = []
+            for i in xrange(size):
+                value += random.gauss(0, 1)
+                rows.append((1236735000 + i * 60, round(value, 2)))
+            for level in (None, 1, 6, 9):
+                client = server.client(compress_uploads=level)
+                server.series['s'] = []
+                body = timetric._encode_multipart({}, {'csv': StringIO(_csv(rows))})
+                compress = level and timed(timetric._gzip_body, body, level) or 0.0
+                server.bytes_in = 0
+                elapsed = timed(lambda: [client.series('s').update(rows)
+                                         for i in xrange(repeat)])
+                if not level:
+                    identity = server.bytes_in
+                results['upload.rows_%s.%s' % (size, level and 'gzip_%s' % level or 'identity')] = {
+                    'wire_kb': server.bytes_in / repeat / 1024.0,
+                    'ratio': float(identity) / server.bytes_in,
+                    'compress_ms': compress * 1e3,
+                    'request_ms': elapsed / repeat * 1e3,
+                }
+            server.series['s'] = rows
+            for gzipped in (False, True):
+                server.gzip = gzipped
+                server.bytes_out = 0
+                elapsed = timed(lambda: [list(client.series('s'))
+                                         for i in xrange(repeat)])
+                results['download.rows_%s.%s' % (size, gzipped and 'gzip' or 'identity')] = {
+                    'wire_kb': server.bytes_out / repeat / 1024.0,
+                    'request_ms': elapsed / repeat * 1e3,
+                }
+    finally:
+        server.stop()
+    return results
+
+@benchmark
+def startup(n=20):
+    """
+    Time fresh interpreters importing timetric, and making an API token
+    client, taking the best of `n` runs and subtracting the interpreter's own
+    startup time.
+    """
+    import subprocess
+    root = os.path.dirname(os.path.abspath(__file__))
+    def best(code):
+        times = []
+        for i in xrange(n):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code],
+                                  env=dict(os.environ, PYTHONPATH=root))
+            times.append(time.time() - start)
+        return min(times)
+    baseline = best('pass')
+    cases = {
+        'import': 'import timetric',
+        'apitoken_client': "import timetric; timetric.TimetricClient("
+                           "{'authtype': 'apitoken', 'apitoken_key': 'k', "
+                           "'apitoken_secret': 's'})",
+    }
+    return dict((name, {'ms': (best(code) - baseline) * 1e3})
+                for (name, code) in cases.items())
+
+def _drain(sock):
+    while sock.recv(1024 * 1024):
+        pass
+    sock.close()
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+@benchmark
+def file_upload(sizes_mb=(16, 64, 256)):
+    """
+    Send a multipart upload of an on-disk file of each size down a local
+    socket, both with `send_to()` (as the client does) and by reading the
+    body 8K at a time (as plain httplib does), noting how much the process's
+    peak RSS grows.
+    """
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for size in sizes_mb:
+            path = os.path.join(directory, '%s.csv' % size)
+            with open(path, 'wb') as f:
+                line = '1236735000,1.5\n'
+                block = line * (1024 * 1024 // len(line))
+                for i in xrange(size):
+                    f.write(block)
+            for how in ('send_to', 'read'):
+                sender, receiver = socket.socketpair()
+                with open(path, 'rb') as f:
+                    body = timetric._encode_multipart({}, {'csv': f})
+                    rss = _max_rss_mb()
+                    start = time.time()
+                    drain = threading.Thread(target=_drain, args=(receiver,))
+                    drain.start()
+                    if how == 'send_to':
+                        body.send_to(sender)
+                    else:
+                        for chunk in iter(lambda: body.read(8192), ''):
+                            sender.sendall(chunk)
+                    sender.close()
+                    drain.join()
+                    elapsed = time.time() - start
+                results['%s.mb_%s' % (how, size)] = {
+                    'mb_per_s': len(body) / elapsed / (1024 * 1024),
+                    'peak_rss_growth_mb': _max_rss_mb() - rss,
+                }
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+@benchmark
+def snapshot(n=10 ** 7):
+    """
+    Save a random-walk series of `n` points (about one in a thousand null)
+    from CSV to a `SeriesSnapshot`, uncompressed and zlib-compressed at
+    several levels, and read it back as blocks and as CSV; for comparison,
+    time parsing the CSV itself into blocks. Everything goes through files in
+    a temporary directory.
+    """
+    import random
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, 'series.csv')
+    results = {}
+    try:
+        with open(csv_path, 'wb') as f:
+            value = 100.0
+            for start in xrange(0, n, 100000):
+                lines = []
+                for i in xrange(start, min(start + 100000, n)):
+                    value += random.gauss(0, 1)
+                    lines.append(random.random() < 0.001 and
+                                 '%s,null\n' % (1236735000 + i * 60) or
+                                 '%s,%.2f\n' % (1236735000 + i * 60, value))
+                f.write(''.join(lines))
+        def parse_csv():
+            with open(csv_path, 'rb') as f:
+                for block in timetric._iter_blocks(f, timetric.CHUNK_SIZE):
+                    timetric.SeriesData().extend_csv(block)
+        results['csv'] = {'size_mb': os.path.getsize(csv_path) / (1024.0 * 1024),
+                          'read_s': timed(parse_csv)}
+        for level in (None, 1, 6):
+            path = os.path.join(directory, 'series.tts')
+            def dump():
+                with open(csv_path, 'rb') as f:
+                    timetric.SeriesSnapshot.from_csv(path, f, level)
+            dump_s = timed(dump)
+            snapshot = timetric.SeriesSnapshot(path)
+            def to_csv():
+                with open(os.path.join(directory, 'out.csv'), 'wb') as f:
+                    snapshot.to_csv(f)
+            results['snapshot.%s' % (level and 'zlib_%s' % level or 'raw')] = {
+                'size_mb': os.path.getsize(path) / (1024.0 * 1024),
+                'dump_s': dump_s,
+                'read_s': timed(lambda: [block for block in snapshot.blocks()]),
+                'to_csv_s': timed(to_csv),
+            }
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def main(args):
+    names = list(args)
+    path = None
+    if '--json' in names:
+        index = names.index('--json')
+        path = names[index + 1]
+        del names[index:index + 2]
+    saved = {}
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        saved[func.__name__] = results = func()
+        for (case, timings) in sorted(results.items()):
+            print "%s.%s: %s" % (func.__name__, case, ', '.join(
+                "%s=%.4f" % item for item in sorted(timings.items())))
+    if path:
+        with open(path, 'w') as f:
+            json.dump({'time': time.time(), 'results': saved}, f,
+                            indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -18,8 +18,10 @@ setup(
     install_requires = [
         'httplib2',
         'python-dateutil',
-        'simplejson',
     ],
+    extras_require = {
+        'simplejson': ['simplejson'],
+    },
     classifiers = [
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
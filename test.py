@@ -13,14 +13,33 @@ You'll realize that this means the tests doen't test the OAuth authenorization
 flow. Patches welcome!
 """
 
+import array
+import BaseHTTPServer
+import cgi
 import datetime
 import ConfigParser
+import email.utils
+import gzip
+import hashlib
+import httplib2
 import os
+import shutil
+import SocketServer
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import timetric
 import unittest
 from cStringIO import StringIO
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 class TimetricTests(unittest.TestCase):
     
     def setUp(self):
@@ -121,7 +140,1636 @@ class TimetricTests(unittest.TestCase):
         time.sleep(5)
         self.assertEqual(list(series), data2)
 
-                
+
+class FakeTimetricHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the small slice of the Timetric HTTP API the client uses, backed
+    by the `FakeTimetric` instance hung off the server.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Responses go out in several small writes; without this, Nagle plus the
+    # client's delayed ACKs hold each response up by ~40ms.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.timetric.lock:
+            self.timetric.connections += 1
+            self.timetric.sockets.add(self.connection)
+
+    def finish(self):
+        with self.timetric.lock:
+            self.timetric.sockets.discard(self.connection)
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def handle_one_request(self):
+        self.timetric.enter()
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            self.timetric.leave()
+
+    def parse_request(self):
+        ok = BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+        if ok:
+            self.timetric.requests.append((self.command, self.path.split('?')[0]))
+            if self.timetric.faults:
+                self.fault = self.timetric.faults.pop(0)
+                self.command = 'FAULT'
+        return ok
+
+    def do_FAULT(self):
+        self.close_connection = 1
+        if self.fault == 'drop':
+            self.connection.shutdown(socket.SHUT_RDWR)
+        elif isinstance(self.fault, tuple):
+            self.respond(*self.fault)
+        else:
+            self.respond(self.fault)
+
+    @property
+    def timetric(self):
+        return self.server.timetric
+
+    def series_path(self):
+        """
+        Split ``/series/<id>/<rest>`` into ``(id, rest)``.
+        """
+        parts = self.path.split('?')[0].split('/')
+        if len(parts) < 4 or parts[1] != 'series':
+            return None, None
+        return parts[2], '/'.join(parts[3:])
+
+    def respond_cacheable(self, body):
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.respond(304, headers={'ETag': etag})
+        elif self.timetric.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            io = StringIO()
+            with gzip.GzipFile(fileobj=io, mode='wb') as f:
+                f.write(body)
+            self.respond(200, io.getvalue(),
+                         headers={'ETag': etag, 'Content-Encoding': 'gzip'})
+        else:
+            self.respond(200, body, headers={'ETag': etag})
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        if status >= 400:
+            # The request body may not have been read; don't reuse the
+            # connection.
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.timetric.lock:
+            self.timetric.bytes_out += len(body)
+
+    def read_body(self):
+        """
+        Read the request body, ungzipping it if need be.
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.timetric.lock:
+            self.timetric.bytes_in += len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return body
+
+    def read_form(self):
+        body = self.read_body()
+        headers = dict(self.headers.items())
+        headers['content-length'] = str(len(body))
+        return cgi.FieldStorage(fp=StringIO(body), headers=headers,
+                                environ={'REQUEST_METHOD': self.command})
+
+    def do_GET(self):
+        id, rest = self.series_path()
+        if id in self.timetric.streamers:
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = 1
+            self.timetric.streamers[id](self.wfile)
+            return
+        if id not in self.timetric.series:
+            return self.respond(404)
+        data = self.timetric.series[id]
+        if rest == 'csv/':
+            query = cgi.parse_qs(self.path.partition('?')[2])
+            start = float(query.get('start', ['-inf'])[0])
+            end = float(query.get('end', ['inf'])[0])
+            self.respond_cacheable(''.join(
+                '%r,%s\n' % (ts, value is None and 'null' or repr(value))
+                for (ts, value) in data if start <= ts <= end))
+        elif rest == 'metadata/json/':
+            self.respond_cacheable(json.dumps(self.timetric.metadata.get(id, {})))
+        elif rest == 'value/json/':
+            if not data:
+                return self.respond(404)
+            ts, value = data[-1]
+            self.respond_cacheable(json.dumps({'timestamp': ts, 'value': value}))
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        if self.path.split('?')[0] == '/create/':
+            id = self.timetric.new_id()
+            form = self.read_form()
+            if 'csv' in form:
+                self.timetric.series[id].extend(_parse_csv(form['csv'].value))
+            self.timetric.metadata[id] = dict((key, form[key].value) for key in form
+                                              if key != 'csv')
+            return self.respond(201, headers={'Location': '/series/%s/' % id})
+        id, rest = self.series_path()
+        if id not in self.timetric.series:
+            return self.respond(404)
+        data = self.timetric.series[id]
+        form = self.read_form()
+        if 'value' in form:
+            data.append((time.time(), float(form['value'].value)))
+        elif 'increment' in form:
+            last = data and data[-1][1] or 0.0
+            data.append((time.time(), last + float(form['increment'].value)))
+        elif 'csv' in form:
+            data.extend(_parse_csv(form['csv'].value))
+        self.respond(204)
+
+    def do_PUT(self):
+        id, rest = self.series_path()
+        if id not in self.timetric.series:
+            return self.respond(404)
+        self.timetric.series[id] = _parse_csv(self.read_body())
+        self.respond(204)
+
+    def do_DELETE(self):
+        id, rest = self.series_path()
+        self.timetric.metadata.pop(id, None)
+        if self.timetric.series.pop(id, None) is None:
+            return self.respond(404)
+        self.respond(204)
+
+class FakeTimetricServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-request are expected; anything else isn't.
+        # At interpreter exit, handler threads can outlive the module globals.
+        if sys is None:
+            return
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class FakeTimetric(object):
+    """
+    A local, in-process stand-in for the Timetric API.
+
+    `series` maps ids to lists of `(timestamp, value)` pairs, and `metadata`
+    maps them to dicts of metadata; `streamers` maps
+    ids to callables that write a CSV body straight to the response file.
+    Each request is held up by `delay` seconds, and the most requests seen
+    in flight at once is kept in `max_active`. `requests` logs the method and
+    path of every request, and `connections` counts connections made.
+
+    `faults` is a list of failures to answer the next requests with: an HTTP
+    status, a `(status, body, headers)` tuple, or 'drop' to hang up without
+    a response.
+
+    Gzipped request bodies are always accepted; responses are only gzipped
+    (when the client asks) if `gzip` is set. `bytes_in` and `bytes_out`
+    count the body bytes that went over the wire each way.
+    """
+    def __init__(self, delay=0):
+        self.series = {}
+        self.metadata = {}
+        self.requests = []
+        self.streamers = {}
+        self.ids = 0
+        self.delay = delay
+        self.active = self.max_active = 0
+        self.connections = 0
+        self.sockets = set()
+        self.faults = []
+        self.gzip = False
+        self.bytes_in = self.bytes_out = 0
+        self.lock = threading.Lock()
+        self.server = FakeTimetricServer(('127.0.0.1', 0), FakeTimetricHandler)
+        self.server.timetric = self
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            for sock in self.sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def enter(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        if self.delay:
+            time.sleep(self.delay)
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def new_id(self):
+        self.ids += 1
+        id = 'fake-%s' % self.ids
+        self.series[id] = []
+        return id
+
+    def client(self, **kwargs):
+        """
+        Make an API token client that talks to this server; `kwargs` go to
+        `TimetricClient`.
+        """
+        config = {'authtype': 'apitoken', 'apitoken_key': 'key',
+                  'apitoken_secret': 'secret'}
+        client = timetric.TimetricClient(config, **kwargs)
+        client.series_url = self.url + 'series/%s/'
+        client.create_url = self.url + 'create/'
+        return client
+
+def _parse_csv(text):
+    return [(float(ts), _parse_value(value))
+            for (ts, value) in (line.split(',') for line in text.splitlines() if line)]
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def _parse_value(value):
+    if value == 'null':
+        return None
+    return float(value)
+
+class StandInTestCase(unittest.TestCase):
+    """
+    Base for tests that run against a `FakeTimetric` rather than the real
+    service.
+    """
+    def setUp(self):
+        self.timetric = FakeTimetric()
+        self.client = self.timetric.client()
+
+    def tearDown(self):
+        self.timetric.stop()
+
+class StreamingTests(StandInTestCase):
+
+    def test_iter_stream(self):
+        data = [(1236735000.0, 1.0), (1236735500.0, 2.5), (1236736000.0, 5.0)]
+        self.timetric.series['s'] = data
+        series = self.client.series('s')
+        self.assertEqual(list(series.iter_stream(chunk_size=7)), data)
+        self.assertEqual(list(series), data)
+
+    def test_iter_stream_missing_series(self):
+        series = self.client.series('missing')
+        self.assertRaises(timetric.TimetricClientError, list, series)
+
+    def test_rows_arrive_before_body_is_complete(self):
+        first_row_seen = threading.Event()
+        stalled = []
+        def streamer(wfile):
+            for i in xrange(0, 10):
+                wfile.write('%s,%s\n' % (1236735000 + i, i))
+            wfile.flush()
+            if not first_row_seen.wait(5):
+                stalled.append(True)
+            for i in xrange(10, 10000):
+                wfile.write('%s,%s\n' % (1236735000 + i, i))
+
+        self.timetric.streamers['big'] = streamer
+        rows = self.client.series('big').iter_stream(chunk_size=16)
+        self.assertEqual(rows.next(), (1236735000.0, 0.0))
+        first_row_seen.set()
+        self.assertEqual(sum(1 for row in rows), 9999)
+        self.assertEqual(stalled, [])
+
+    def test_streams_use_the_clients_proxy(self):
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+        proxy = FakeTimetric()
+        try:
+            self.client.http.proxy_info = httplib2.ProxyInfo(
+                httplib2.socks.PROXY_TYPE_HTTP, '127.0.0.1', proxy.server.server_address[1])
+            self.assertRaises(Exception, list, self.client.series('s'))
+            self.assertEqual(proxy.requests[0][0], 'CONNECT')
+            self.assertEqual(self.timetric.requests, [])
+        finally:
+            proxy.stop()
+
+    def test_stalled_streams_time_out(self):
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+        self.timetric.delay = 0.5
+        self.client.stream_timeout = 0.1
+        self.assertRaises(socket.timeout, list, self.client.series('s'))
+
+class MultipartTests(StandInTestCase):
+
+    def test_encoding(self):
+        body = timetric._encode_multipart({'title': 'A title'},
+                                          {'csv': StringIO('1,2\n3,4\n')})
+        expected = '\r\n'.join([
+            '--' + timetric.BOUNDARY,
+            'Content-Disposition: form-data; name="title"',
+            '',
+            'A title',
+            '--' + timetric.BOUNDARY,
+            'Content-Disposition: form-data; name="csv"; filename="csv"',
+            'Content-Type: application/octet-stream',
+            '',
+            '1,2\n3,4\n',
+            '--' + timetric.BOUNDARY + '--',
+            '',
+        ])
+        self.assertEqual(len(body), len(expected))
+        self.assertEqual(''.join(iter(lambda: body.read(5), '')), expected)
+
+    def test_body_starts_again_once_read(self):
+        body = timetric._encode_multipart({'title': 'A title'},
+                                          {'csv': StringIO('1,2\n3,4\n')})
+        first = ''.join(iter(lambda: body.read(7), ''))
+        self.assertEqual(len(first), len(body))
+        self.assertEqual(''.join(iter(lambda: body.read(7), '')), first)
+        self.assertEqual(body.read(), first)
+        self.assertEqual(body.read(), '')
+        self.assertEqual(body.read(), first)
+
+    def test_files_are_read_lazily(self):
+        io = StringIO('x' * (timetric.CHUNK_SIZE * 3))
+        body = timetric._encode_multipart({}, {'csv': io})
+        self.assertEqual(io.tell(), 0)
+        body.read(100)
+        self.assertTrue(io.tell() <= timetric.CHUNK_SIZE)
+
+    def test_unsized_files_are_spooled(self):
+        class Pipe(object):
+            def __init__(self, data):
+                self.io = StringIO(data)
+            def read(self, size=-1):
+                return self.io.read(size)
+        body = timetric._encode_multipart({}, {'csv': Pipe('1,2\n')})
+        self.assertTrue(body.read().find('\r\n1,2\n\r\n') > 0)
+
+    def test_update_from_iterable(self):
+        self.timetric.series['s'] = []
+        data = [(1236735000 + i, float(i)) for i in xrange(5000)]
+        self.client.series('s').update(data)
+        self.assertEqual(self.timetric.series['s'], data)
+
+    def test_create_series_with_file(self):
+        series = self.client.create_series(
+            title='t', caption='c',
+            data=StringIO('1236735000,1.0\n1236735500,2.5\n'),
+        )
+        self.assertEqual(list(series), [(1236735000.0, 1.0), (1236735500.0, 2.5)])
+
+class FileUploadTests(StandInTestCase):
+
+    def setUp(self):
+        super(FileUploadTests, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.csv')
+        self.data = [(1236735000.0 + i, float(i)) for i in xrange(20000)]
+        with open(self.path, 'wb') as f:
+            f.write(''.join('%r,%r\n' % row for row in self.data))
+
+    def tearDown(self):
+        super(FileUploadTests, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_files_are_mapped(self):
+        class Socket(object):
+            def __init__(self):
+                self.sent = []
+            def sendall(self, data):
+                # Mapped buffers are only valid until the window's closed.
+                self.sent.append((type(data), str(data)))
+        mmap_window = timetric.MMAP_WINDOW
+        timetric.MMAP_WINDOW = timetric.CHUNK_SIZE * 3
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(12345)
+                body = timetric.BodyStream(['head', f, 'tail'])
+                sock = Socket()
+                body.send_to(sock)
+                f.seek(12345)
+                expected = 'head' + f.read() + 'tail'
+        finally:
+            timetric.MMAP_WINDOW = mmap_window
+        self.assertEqual(''.join(data for (kind, data) in sock.sent), expected)
+        self.assertEqual(len(body), len(expected))
+        self.assertTrue(len(sock.sent) > 6)
+        self.assertTrue(all(kind is buffer for (kind, data) in sock.sent[1:-1]))
+
+    def test_read_matches_send_to(self):
+        with open(self.path, 'rb') as f:
+            body = timetric._encode_multipart({'a': 'b'}, {'csv': f})
+            pieces = ''.join(iter(lambda: body.read(8192), ''))
+            body.rewind()
+            self.assertEqual(pieces, body.read())
+            self.assertEqual(len(pieces), len(body))
+
+    def test_spooled_files_stay_in_memory(self):
+        spool = timetric._iterable_to_stream(self.data[:10])
+        body = timetric.BodyStream([spool])
+        self.assertFalse(spool._rolled)
+        self.assertEqual(len(body), len(body.read()))
+
+    def test_update_from_file(self):
+        self.timetric.series['s'] = []
+        with open(self.path, 'rb') as f:
+            self.client.series('s').update(f)
+        self.assertEqual(self.timetric.series['s'], self.data)
+
+    def test_rewrite_from_file(self):
+        self.timetric.series['s'] = [(1.0, 2.0)]
+        with open(self.path, 'rb') as f:
+            self.client.series('s').rewrite(f)
+        self.assertEqual(self.timetric.series['s'], self.data)
+
+    def test_rewrite_from_iterable(self):
+        self.timetric.series['s'] = [(1.0, 2.0)]
+        self.client.series('s').rewrite(self.data[:3])
+        self.assertEqual(self.timetric.series['s'], self.data[:3])
+
+class CompressionTests(StandInTestCase):
+
+    def setUp(self):
+        super(CompressionTests, self).setUp()
+        self.data = [(1236735000.0 + i, float(i % 10)) for i in xrange(5000)]
+
+    def test_streamed_reads_are_decompressed(self):
+        self.timetric.gzip = True
+        self.timetric.series['s'] = self.data
+        self.assertEqual(list(self.client.series('s').iter_stream(chunk_size=100)), self.data)
+        compressed = self.timetric.bytes_out
+        self.client.gzip_responses = False
+        self.assertEqual(list(self.client.series('s')), self.data)
+        self.assertTrue(compressed * 5 < self.timetric.bytes_out - compressed)
+
+    def test_gzip_response_reads(self):
+        body = ''.join('%s,%s\n' % row for row in self.data)
+        io = StringIO()
+        with gzip.GzipFile(fileobj=io, mode='wb') as f:
+            f.write(body)
+        class Response(object):
+            def __init__(self):
+                self.io = StringIO(io.getvalue())
+            def read(self, size=-1):
+                return self.io.read(size)
+            def getheader(self, name):
+                return {'content-encoding': 'gzip'}.get(name)
+        resp = timetric._decoded(Response())
+        self.assertEqual(resp.read(10), body[:10])
+        self.assertEqual(''.join(iter(lambda: resp.read(1000), '')), body[10:])
+        self.assertEqual(timetric._decoded(Response()).read(), body)
+        for size in (1, 10, 4096, len(body) - 1):
+            resp = timetric._decoded(Response())
+            self.assertEqual(resp.read(size), body[:size])
+            self.assertEqual(resp.read(), body[size:])
+            self.assertEqual(resp.read(), '')
+        resp = timetric._decoded(Response())
+        resp.pending = body[:100]
+        self.assertEqual(resp.read(), body[:100] + body)
+
+    def test_compressed_uploads(self):
+        self.timetric.series['s'] = []
+        client = self.timetric.client(compress_uploads=6)
+        client.series('s').update(self.data)
+        self.assertEqual(self.timetric.series['s'], self.data)
+        compressed = self.timetric.bytes_in
+        self.client.series('s').update(self.data)
+        self.assertTrue(compressed * 5 < self.timetric.bytes_in - compressed)
+
+    def test_compressed_rewrite(self):
+        self.timetric.series['s'] = [(1.0, 2.0)]
+        client = self.timetric.client(compress_uploads=1)
+        client.series('s').rewrite(self.data)
+        self.assertEqual(self.timetric.series['s'], self.data)
+        self.assertEqual(self.timetric.requests, [('PUT', '/series/s/')])
+
+    def test_small_posts_are_not_compressed(self):
+        self.timetric.series['s'] = []
+        self.timetric.client(compress_uploads=9).series('s').increment(2)
+        self.assertEqual(self.timetric.series['s'][-1][1], 2.0)
+        self.assertEqual(self.timetric.bytes_in, len('increment=2'))
+
+class SeriesCacheTests(StandInTestCase):
+
+    def test_handles_are_reused(self):
+        series = self.client.series('s')
+        self.assertTrue(self.client.series('s') is series)
+        self.assertFalse(self.client.series('t') is series)
+        self.assertFalse(hasattr(series, '__dict__'))
+
+    def test_handles_are_bounded(self):
+        self.client.max_series_handles = 10
+        for i in xrange(25):
+            self.client.series('s%s' % i)
+        self.assertEqual(len(self.client.handles), 10)
+
+    def test_created_series_metadata_comes_from_the_server(self):
+        series = self.client.create_series(title='A title', caption='A caption',
+                                           units='m')
+        self.assertTrue(self.client.series(series.id) is series)
+        self.timetric.metadata[series.id]['created'] = '2009-03-11'
+        expected = {'title': 'A title', 'caption': 'A caption', 'units': 'm',
+                    'created': '2009-03-11'}
+        self.assertEqual(series.metadata(), expected)
+        self.assertEqual(series.metadata(), expected)
+        self.assertEqual(self.timetric.requests, [
+            ('POST', '/create/'), ('GET', '/series/%s/metadata/json/' % series.id)])
+        self.assertEqual(series.metadata(refresh=True), expected)
+        self.assertEqual(len(self.timetric.requests), 3)
+
+    def test_metadata_ttl(self):
+        self.timetric.series['s'] = []
+        self.timetric.metadata['s'] = {'title': 'Old'}
+        self.client.metadata_ttl = 0.05
+        self.assertEqual(self.client.series('s').metadata(), {'title': 'Old'})
+        self.timetric.metadata['s'] = {'title': 'New'}
+        self.assertEqual(self.client.series('s').metadata(), {'title': 'Old'})
+        time.sleep(0.1)
+        self.assertEqual(self.client.series('s').metadata(), {'title': 'New'})
+        self.assertEqual(self.client.metadata_stats, {'hits': 1, 'misses': 2})
+
+    def test_rewrite_and_delete_invalidate(self):
+        self.timetric.series['s'] = []
+        self.timetric.metadata['s'] = {'title': 'T'}
+        series = self.client.series('s')
+        series.metadata()
+        series.rewrite([(1236735000.0, 1.0)])
+        series.metadata()
+        self.assertEqual(self.client.metadata_stats, {'hits': 0, 'misses': 2})
+        self.timetric.faults = [503, 503]
+        self.assertRaises(timetric.TimetricClientError, series.rewrite, [])
+        self.assertRaises(timetric.TimetricClientError, series.delete)
+        self.assertTrue(self.client.series('s') is series)
+        series.metadata()
+        self.assertEqual(self.client.metadata_stats, {'hits': 1, 'misses': 2})
+        series.delete()
+        self.assertFalse('s' in self.client.handles)
+        self.assertRaises(timetric.TimetricClientError, series.metadata)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ArrayTests(StandInTestCase):
+
+    def setUp(self):
+        if numpy is None:
+            self.skipTest("NumPy isn't installed")
+        super(ArrayTests, self).setUp()
+
+    def test_to_arrays(self):
+        self.timetric.streamers['s'] = lambda wfile: wfile.write(
+            '1236735000,1.0\n1236735500,null\n1236736000,5.0\n')
+        ts, values = self.client.series('s').to_arrays(chunk_size=10)
+        self.assertEqual(ts.dtype, numpy.float64)
+        self.assertEqual(ts.tolist(), [1236735000.0, 1236735500.0, 1236736000.0])
+        self.assertEqual(values[0], 1.0)
+        self.assertTrue(numpy.isnan(values[1]))
+        self.assertEqual(values[2], 5.0)
+
+    def test_update_arrays(self):
+        self.timetric.series['s'] = []
+        ts = numpy.arange(1236735000, 1236745000, dtype=numpy.float64)
+        values = numpy.linspace(0, 1, len(ts))
+        series = self.client.series('s')
+        series.update_arrays(ts, values)
+        got_ts, got_values = series.to_arrays()
+        self.assertTrue((got_ts == ts).all())
+        self.assertTrue((got_values == values).all())
+
+    def test_update_arrays_datetime64(self):
+        # datetime64s are local time, just as naive datetimes are in update().
+        self.timetric.series['s'] = []
+        self.timetric.series['t'] = []
+        dates = [datetime.datetime(2009, 1, 11, 1, 30),
+                 datetime.datetime(2009, 3, 11, 1, 30, 0, 250000),
+                 datetime.datetime(2009, 7, 11, 13, 45)]
+        ts = numpy.array([d.isoformat() for d in dates], dtype='datetime64[us]')
+        self.client.series('s').update_arrays(ts, [1.0, 2.5, 4.0])
+        self.client.series('t').update(zip(dates, [1.0, 2.5, 4.0]))
+        self.assertEqual(self.timetric.series['s'], self.timetric.series['t'])
+        self.assertEqual(self.timetric.series['s'][1],
+                         (time.mktime(dates[1].timetuple()) + 0.25, 2.5))
+
+    def test_update_arrays_length_mismatch(self):
+        series = self.client.series('s')
+        self.assertRaises(ValueError, series.update_arrays, [1, 2], [1.0])
+
+class AsyncClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.timetric = FakeTimetric(delay=0.05)
+        self.client = timetric.AsyncTimetricClient(
+            {'authtype': 'apitoken', 'apitoken_key': 'key',
+             'apitoken_secret': 'secret'},
+            max_concurrency=4,
+        )
+        self.client.series_url = self.timetric.url + 'series/%s/'
+        self.client.create_url = self.timetric.url + 'create/'
+
+    def tearDown(self):
+        self.client.close()
+        self.timetric.stop()
+
+    def test_latest_with_bounded_concurrency(self):
+        for i in xrange(20):
+            self.timetric.series['s%s' % i] = [(1236735000.0, float(i))]
+        futures = [self.client.series('s%s' % i).latest() for i in xrange(20)]
+        self.assertEqual([f.result(5) for f in futures],
+                         [(1236735000.0, float(i)) for i in xrange(20)])
+        self.assertEqual(self.timetric.max_active, 4)
+
+    def test_write_calls(self):
+        series = self.client.create_series(title='t', caption='c').result(5)
+        self.assertTrue(isinstance(series, timetric.AsyncSeries))
+        series.update(10.0).result(5)
+        series.increment(2.5).result(5)
+        self.assertEqual(series.latest().result(5)[1], 12.5)
+        series.rewrite([(1236735000, 1.0)]).result(5)
+        self.assertEqual(series.fetch().result(5), [(1236735000.0, 1.0)])
+        series.delete().result(5)
+        self.assertFalse(series.id in self.timetric.series)
+
+    def test_errors_are_raised_from_result(self):
+        future = self.client.series('missing').latest()
+        self.assertRaises(timetric.TimetricClientError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(),
+                                   timetric.TimetricClientError))
+
+class BatchTests(StandInTestCase):
+
+    def setUp(self):
+        super(BatchTests, self).setUp()
+        self.timetric.series['s'] = [(1236735000.0, 10.0)]
+
+    def test_increments_are_coalesced(self):
+        with self.client.batch(interval=60) as batch:
+            series = batch.series('s')
+            for i in xrange(100):
+                series.increment(1)
+            series -= 0.5
+        self.assertEqual(self.timetric.series['s'][-1][1], 109.5)
+        self.assertEqual(self.timetric.requests, [('POST', '/series/s/')])
+
+    def test_updates_are_sent_as_csv_in_order(self):
+        batch = self.client.batch(interval=60)
+        series = batch.series('s')
+        series.update(1.0)
+        series.update(2.0)
+        series.increment(5)
+        series.update([(1236736000, 3.0)])
+        batch.flush()
+        self.assertEqual([v for (ts, v) in self.timetric.series['s']],
+                         [10.0, 1.0, 2.0, 7.0, 3.0])
+        self.assertEqual(len(self.timetric.requests), 3)
+        batch.close()
+
+    def test_flushes_at_max_rows(self):
+        batch = self.client.batch(max_rows=10, interval=60)
+        for i in xrange(10):
+            batch.series('s').update(float(i))
+        deadline = time.time() + 5
+        while len(self.timetric.series['s']) < 11 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.timetric.series['s']), 11)
+        batch.close()
+
+    def test_errors_are_raised_on_flush(self):
+        batch = self.client.batch(interval=60)
+        batch.series('missing').increment(1)
+        self.assertRaises(timetric.TimetricClientError, batch.flush)
+        batch.close()
+        self.assertRaises(timetric.TimetricClientError,
+                          batch.series('s').increment, 1)
+
+    def test_client_can_be_used_while_flushing(self):
+        batch = self.client.batch(max_rows=1, interval=60)
+        self.assertTrue(isinstance(self.client.http, timetric.HttpPool))
+        for i in xrange(20):
+            batch.series('s').increment(1)
+            self.assertTrue(self.client.series('s').csv())
+        batch.close()
+        self.assertEqual(self.timetric.series['s'][-1][1], 30.0)
+
+    def test_blocked_writes_fail_on_close(self):
+        self.timetric.delay = 0.2
+        batch = self.client.batch(max_buffered=1, interval=60)
+        batch.series('s').increment(1)
+        errors = []
+        def write():
+            try:
+                batch.series('s').increment(1)
+            except timetric.TimetricClientError, e:
+                errors.append(e)
+        thread = threading.Thread(target=write)
+        thread.start()
+        time.sleep(0.05)
+        batch.close()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.timetric.series['s'][-1][1], 11.0)
+
+class WriterTests(StandInTestCase):
+
+    def setUp(self):
+        super(WriterTests, self).setUp()
+        for id in 'abcd':
+            self.timetric.series[id] = [(1236735000.0, 0.0)]
+
+    def stalled_writer(self, overflow):
+        """
+        Get a one-thread writer that's busy sending an increment to 'a'.
+        """
+        self.timetric.delay = 0.2
+        writer = self.client.writer(max_queued=2, senders=1, overflow=overflow)
+        writer.series('a').increment(1)
+        deadline = time.time() + 5
+        while not writer.sending and time.time() < deadline:
+            time.sleep(0.001)
+        return writer
+
+    def latest(self, id):
+        return self.timetric.series[id][-1][1]
+
+    def test_writes_to_a_series_stay_in_order(self):
+        with self.client.writer(senders=4) as writer:
+            for i in xrange(50):
+                for id in 'abcd':
+                    writer.series(id).update(float(i))
+                    writer.series(id).increment(0.5)
+        for id in 'abcd':
+            values = [v for (ts, v) in self.timetric.series[id]]
+            self.assertEqual(values[-1], 49.5)
+            self.assertEqual(values, sorted(values))
+        stats = writer.stats()
+        self.assertEqual(stats['enqueued'], 400)
+        self.assertEqual(stats['sent'], 400)
+        self.assertEqual(stats['depth'], 0)
+        self.assertTrue(stats['requests'] <= 400)
+        self.assertTrue(stats['max_lag'] >= stats['mean_lag'] > 0)
+
+    def test_drop_oldest(self):
+        writer = self.stalled_writer('drop_oldest')
+        for id in 'bcd':
+            writer.series(id).increment(1)
+        writer.close()
+        self.assertEqual([self.latest(id) for id in 'abcd'], [1, 0, 1, 1])
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    def test_drop_newest(self):
+        writer = self.stalled_writer('drop_newest')
+        for id in 'bcd':
+            writer.series(id).increment(1)
+        writer.close()
+        self.assertEqual([self.latest(id) for id in 'abcd'], [1, 1, 1, 0])
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    def test_block(self):
+        writer = self.stalled_writer('block')
+        for id in 'bcd':
+            writer.series(id).increment(1)
+        self.assertEqual(writer.stats()['max_depth'], 2)
+        writer.close()
+        self.assertEqual([self.latest(id) for id in 'abcd'], [1, 1, 1, 1])
+        self.assertEqual(writer.stats()['dropped'], 0)
+
+    def test_errors_are_raised_on_flush(self):
+        writer = self.client.writer()
+        writer.series('missing').increment(1)
+        self.assertRaises(timetric.TimetricClientError, writer.flush)
+        self.assertEqual(writer.stats()['failed'], 1)
+        writer.close()
+        self.assertRaises(timetric.TimetricClientError,
+                          writer.series('a').increment, 1)
+
+    def test_bad_overflow(self):
+        self.assertRaises(ValueError, self.client.writer, overflow='spill')
+        self.assertRaises(ValueError, self.client.writer, max_queued=0,
+                          overflow='drop_oldest')
+        self.assertRaises(ValueError, self.client.writer, senders=0)
+        self.assertFalse(isinstance(self.client.http, timetric.HttpPool))
+
+class HttpPoolTests(StandInTestCase):
+
+    def setUp(self):
+        super(HttpPoolTests, self).setUp()
+        self.client = self.timetric.client()
+        self.client.http = timetric.HttpPool(size=8)
+        self.client.http.follow_redirects = False
+
+    def test_threads_share_connections(self):
+        for i in xrange(64):
+            self.timetric.series['s%s' % i] = [(1236735000.0, float(i))]
+        errors = []
+        def worker(i):
+            try:
+                series = self.client.series('s%s' % i)
+                for j in xrange(10):
+                    if series.latest() != (1236735000.0, float(i)):
+                        errors.append('wrong value for s%s' % i)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(64)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        stats = self.client.http.stats
+        self.assertEqual(stats['hits'] + stats['misses'], 640)
+        self.assertTrue(stats['misses'] <= 8)
+        self.assertTrue(self.timetric.connections <= 8)
+        self.assertTrue(stats['waits'] > 0)
+
+    def test_idle_connections_expire(self):
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+        self.client.http.idle_timeout = 0
+        self.client.series('s').latest()
+        time.sleep(0.01)
+        self.client.series('s').latest()
+        self.assertEqual(self.client.http.stats['expired'], 1)
+        self.assertEqual(self.client.http.stats['misses'], 2)
+
+    def test_pool_size_option(self):
+        client = timetric.TimetricClient({'authtype': 'apitoken',
+                                          'apitoken_key': 'key',
+                                          'apitoken_secret': 'secret'},
+                                         pool_size=4)
+        self.assertEqual(client.http.size, 4)
+        self.assertEqual(client.http.follow_redirects, False)
+
+    def test_swapping_in_a_pool_closes_old_connections(self):
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+        client = self.timetric.client()
+        client.series('s').latest()
+        old = client.http
+        self.assertTrue([conn for conn in old.connections.values() if conn.sock])
+        client._ensure_pool(2)
+        self.assertTrue(isinstance(client.http, timetric.HttpPool))
+        self.assertEqual([conn for conn in old.connections.values() if conn.sock], [])
+        self.assertEqual(client.series('s').latest(), (1236735000.0, 1.0))
+
+class FetchManyTests(StandInTestCase):
+
+    def setUp(self):
+        super(FetchManyTests, self).setUp()
+        self.timetric.delay = 0.02
+        for i in xrange(20):
+            self.timetric.series['s%s' % i] = [(1236735000.0, float(i))]
+        self.ids = ['s%s' % i for i in xrange(20)] + ['missing']
+
+    def test_fetch_many(self):
+        results, errors = self.client.fetch_many(self.ids, max_workers=5)
+        self.assertEqual(results.keys(), self.ids[:-1])
+        self.assertEqual(results['s3'], (1236735000.0, 3.0))
+        self.assertEqual(errors.keys(), ['missing'])
+        self.assertTrue(isinstance(errors['missing'], timetric.TimetricClientError))
+        self.assertEqual(self.timetric.max_active, 5)
+
+    def test_fetch_csv_as_completed(self):
+        seen = {}
+        for (id, result, error) in self.client.fetch_as_completed(self.ids, 'csv'):
+            seen[id] = (result, error)
+        self.assertEqual(len(seen), 21)
+        self.assertEqual(seen['s1'][0], '1236735000.0,1.0\n')
+        self.assertTrue(seen['missing'][0] is None)
+
+    def test_bad_what(self):
+        self.assertRaises(ValueError, self.client.fetch_many, self.ids, 'everything')
+
+class BulkUpdateTests(StandInTestCase):
+
+    def test_bulk_update(self):
+        for i in xrange(20):
+            self.timetric.series['s%s' % i] = []
+        data = dict(('s%s' % i, [(1236735000.0 + j, float(i)) for j in xrange(i + 1)])
+                    for i in xrange(20))
+        data['s0'] = StringIO('1236735000.0,7.0\n')
+        data['missing'] = [(1236735000.0, 1.0)]
+        seen = []
+        report = self.client.bulk_update(data, max_workers=4,
+                                         progress=lambda r: seen.append(len(r.results)))
+        self.assertEqual(sorted(report.results), sorted('s%s' % i for i in xrange(20)))
+        self.assertEqual(report.errors.keys(), ['missing'])
+        self.assertEqual(self.timetric.series['s0'], [(1236735000.0, 7.0)])
+        self.assertEqual(self.timetric.series['s19'], data['s19'])
+        self.assertEqual(report.results['s19']['rows'], 20)
+        self.assertEqual(report.results['s0']['rows'], None)
+        self.assertEqual(report.rows, sum(xrange(2, 21)))
+        self.assertEqual(report.bytes, sum(r['bytes'] for r in report.results.values()))
+        self.assertTrue(report.rows_per_s > 0 and report.mb_per_s > 0)
+        self.assertEqual(len(seen), 21)
+
+    def test_generators_are_read_as_sent(self):
+        self.timetric.delay = 0.01
+        read = []
+        def series():
+            for i in xrange(50):
+                read.append(len(self.timetric.requests))
+                self.timetric.series['s%s' % i] = []
+                yield 's%s' % i, [(1236735000.0, float(i))]
+        report = self.client.bulk_update(series(), max_workers=2)
+        self.assertEqual(len(report.results), 50)
+        self.assertTrue(read[-1] > 40)
+        self.assertEqual(self.timetric.max_active, 2)
+
+class CacheTests(StandInTestCase):
+
+    def setUp(self):
+        super(CacheTests, self).setUp()
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+
+    def assertRevalidates(self, cache):
+        self.client.cache = cache
+        series = self.client.series('s')
+        self.assertEqual(series.csv(), '1236735000.0,1.0\n')
+        self.assertEqual(series.csv(), '1236735000.0,1.0\n')
+        self.assertEqual(self.client.cache_stats,
+                         {'hits': 1, 'misses': 1, 'revalidations': 1})
+        self.timetric.series['s'].append((1236735500.0, 2.0))
+        self.assertEqual(series.csv(), '1236735000.0,1.0\n1236735500.0,2.0\n')
+        self.assertEqual(self.client.cache_stats,
+                         {'hits': 1, 'misses': 2, 'revalidations': 2})
+        self.assertEqual(series.latest(), (1236735500.0, 2.0))
+        self.assertEqual(series.latest(), (1236735500.0, 2.0))
+        self.assertEqual(self.client.cache_stats['hits'], 2)
+
+    def test_memory_cache(self):
+        self.assertRevalidates(timetric.MemoryCache())
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertRevalidates(timetric.DiskCache(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_memory_cache_byte_budget(self):
+        cache = timetric.MemoryCache(max_bytes=10)
+        cache.set('a', ({}, '12345'))
+        cache.set('b', ({}, '12345'))
+        cache.get('a')
+        cache.set('c', ({}, '123'))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), ({}, '12345'))
+        self.assertEqual(cache.size, 8)
+        cache.set('d', ({}, 'x' * 11))
+        self.assertEqual(cache.get('d'), None)
+
+class MirrorTests(StandInTestCase):
+
+    def setUp(self):
+        super(MirrorTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.mirror = timetric.SeriesMirror(self.directory)
+        self.data = self.timetric.series['s'] = [
+            (1236735000.0, 1.0), (1236735500.0, 0.0), (1236736000.0, 5.0)]
+        self.series = self.client.series('s')
+
+    def tearDown(self):
+        super(MirrorTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_sync_and_read(self):
+        self.assertEqual(self.series.sync(self.mirror), 3)
+        self.assertEqual(list(self.mirror.points('s')), self.data)
+        ts, values = self.mirror.arrays('s')
+        self.assertEqual(list(ts), [p[0] for p in self.data])
+        self.assertEqual(list(values), [p[1] for p in self.data])
+        self.assertEqual(self.mirror.last('s'), (1236736000.0, 5.0))
+
+    def test_unchanged_series_isnt_downloaded(self):
+        self.series.sync(self.mirror)
+        self.assertEqual(self.series.sync(self.mirror), 0)
+        self.assertEqual(self.mirror.count('s'), 3)
+
+    def test_only_new_points_are_added(self):
+        self.series.sync(self.mirror)
+        self.data.append((1236736500.0, 6.0))
+        self.assertEqual(self.series.sync(self.mirror), 1)
+        self.assertEqual(list(self.mirror.points('s')), self.data)
+
+    def test_rewritten_series_is_rebuilt(self):
+        self.series.sync(self.mirror)
+        self.timetric.series['s'] = [(1236735000.0, 9.0), (1236737000.0, 10.0)]
+        self.assertEqual(self.series.sync(self.mirror), 2)
+        self.assertEqual(list(self.mirror.points('s')), self.timetric.series['s'])
+
+    def test_server_ranges_fetch_only_new_points(self):
+        self.client.server_ranges = True
+        self.series.sync(self.mirror)
+        self.data.append((1236736500.0, 6.0))
+        self.timetric.bytes_out = 0
+        self.assertEqual(self.series.sync(self.mirror), 1)
+        self.assertEqual(list(self.mirror.points('s')), self.data)
+        self.assertEqual(self.timetric.bytes_out,
+                         len('1236736000.0,5.0\n1236736500.0,6.0\n'))
+
+    def test_server_ranges_rebuild_if_last_point_changes(self):
+        self.client.server_ranges = True
+        self.series.sync(self.mirror)
+        self.timetric.series['s'] = [(1236735000.0, 9.0), (1236737000.0, 10.0)]
+        self.assertEqual(self.series.sync(self.mirror), 2)
+        self.assertEqual(list(self.mirror.points('s')), self.timetric.series['s'])
+
+    def test_partial_records_are_dropped(self):
+        self.series.sync(self.mirror)
+        f = open(self.mirror.path('s'), 'ab')
+        f.write('junk')
+        f.close()
+        self.assertEqual(self.series.sync(self.mirror), 0)
+        self.assertEqual(list(self.mirror.points('s')), self.data)
+
+    def test_nulls(self):
+        self.timetric.streamers['n'] = lambda wfile: wfile.write(
+            '1236735000,null\n1236735500,2.5\n')
+        self.client.series('n').sync(self.mirror)
+        self.assertEqual(list(self.mirror.points('n')),
+                         [(1236735000.0, None), (1236735500.0, 2.5)])
+
+    def test_literals(self):
+        self.timetric.streamers['l'] = lambda wfile: wfile.write(
+            '1236735000,false\n1236735500,NULL\n1236736000,true\n')
+        self.client.series('l').sync(self.mirror)
+        self.assertEqual(list(self.mirror.points('l')),
+                         [(1236735000.0, 0.0), (1236735500.0, None),
+                          (1236736000.0, 1.0)])
+        self.assertTrue(timetric._valueish('false') is False)
+        self.assertTrue(timetric._valueish('null') is None)
+
+class SeriesDataTests(StandInTestCase):
+
+    points = [(1236735000.0 + i * 10, i % 3 and float(i) or None)
+              for i in xrange(20)]
+
+    def test_fetch(self):
+        self.timetric.streamers['s'] = lambda wfile: wfile.write(
+            ''.join('%s,%s\n' % (ts, value is None and 'null' or value)
+                    for (ts, value) in self.points))
+        data = self.client.series('s').fetch(chunk_size=50)
+        self.assertTrue(isinstance(data, timetric.SeriesData))
+        self.assertEqual(len(data), 20)
+        self.assertEqual(list(data), self.points)
+        self.assertEqual(data.null_count, 7)
+
+    def test_indexing_and_slicing(self):
+        data = timetric.SeriesData(self.points)
+        self.assertEqual(data[0], self.points[0])
+        self.assertEqual(data[-1], self.points[-1])
+        self.assertEqual(list(data[3:17:2]), self.points[3:17:2])
+        self.assertEqual(list(data[::-1]), self.points[::-1])
+        self.assertEqual(data[5:9].null_count, 1)
+        self.assertEqual(list(data[8:19]), self.points[8:19])
+        self.assertEqual(data[8:19].null_count, 4)
+        self.assertEqual(data[16:].null_count, 1)
+        self.assertEqual(data[-20], self.points[0])
+        self.assertRaises(IndexError, data.__getitem__, -21)
+        self.assertRaises(IndexError, data.__getitem__, 20)
+
+    def test_between(self):
+        data = timetric.SeriesData(self.points)
+        self.assertEqual(list(data.between(1236735050.0, 1236735100.0)),
+                         self.points[5:10])
+        self.assertEqual(list(data.between(end=1236735015.0)), self.points[:2])
+        self.assertEqual(list(data.between(start=1236736000.0)), [])
+
+    def test_buffers(self):
+        data = timetric.SeriesData([(1.0, 2.0), (3.0, None)])
+        timestamps, values, nulls = data.buffers()
+        self.assertEqual(len(timestamps), 16)
+        self.assertEqual(str(nulls), '\x02')
+        data.timestamps[0] = 5.0
+        self.assertEqual(timestamps[:8], array.array('d', [5.0]).tostring())
+
+class SnapshotTests(StandInTestCase):
+
+    points = [(1236735000.0 + i * 10, i % 3 and i * 0.1 or None)
+              for i in xrange(20)]
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 's.tts')
+        self.timetric.series['s'] = list(self.points)
+
+    def tearDown(self):
+        super(SnapshotTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_dump_and_load(self):
+        for compress in (None, 6):
+            snapshot = self.client.series('s').dump(self.path, compress, chunk_size=50,
+                                                    block_size=6)
+            self.assertEqual(len(snapshot), 20)
+            self.assertEqual(list(snapshot), self.points)
+            self.assertEqual(map(len, snapshot.blocks()), [6, 6, 6, 2])
+            data = snapshot.data()
+            self.assertEqual(data, self.points)
+            self.assertEqual(data.null_count, 7)
+            self.timetric.series['t'] = []
+            self.client.series('t').load(self.path)
+            self.assertEqual(self.timetric.series['t'], self.points)
+
+    def test_csv_conversion(self):
+        csv = '1236735000,1.5\n1236735010,null\n1236735020,true\n'
+        snapshot = timetric.SeriesSnapshot.from_csv(self.path, StringIO(csv))
+        self.assertEqual(snapshot.to_csv(StringIO()).getvalue(),
+                         '1236735000.0,1.5\n1236735010.0,null\n1236735020.0,1.0\n')
+        snapshot = timetric.SeriesSnapshot.from_csv(self.path, StringIO(''))
+        self.assertEqual(len(snapshot), 0)
+        self.assertEqual(snapshot.to_csv().read(), '')
+
+    def test_compression(self):
+        self.timetric.series['s'] = [(1236735000.0 + i * 10, 100.0 + i % 10)
+                                     for i in xrange(1000)]
+        plain = self.client.series('s').dump(self.path, block_size=1024)
+        size = os.path.getsize(self.path)
+        self.client.series('s').dump(self.path, compress=6, block_size=1024)
+        self.assertTrue(os.path.getsize(self.path) * 10 < size)
+        self.assertEqual(list(plain), self.timetric.series['s'])
+
+    def test_bad_files(self):
+        self.client.series('s').dump(self.path)
+        with open(self.path, 'r+b') as f:
+            f.seek(-20, os.SEEK_END)
+            f.write('x')
+        self.assertRaises(ValueError, list, timetric.SeriesSnapshot(self.path))
+        with open(self.path, 'wb') as f:
+            f.write('1236735000,1.5\n')
+        self.assertRaises(ValueError, len, timetric.SeriesSnapshot(self.path))
+
+    def test_default_block_size(self):
+        self.assertEqual(timetric.SeriesSnapshot.block_size, 64 * 1024)
+        snapshot = self.client.series('s').dump(self.path)
+        self.assertEqual(map(len, snapshot.blocks()), [20])
+
+class RangeTests(StandInTestCase):
+
+    def setUp(self):
+        super(RangeTests, self).setUp()
+        self.timetric.series['s'] = [(1236735000.0 + i * 10, float(i)) for i in xrange(100)]
+        self.series = self.client.series('s')
+
+    def test_range(self):
+        expected = [(1236735000.0 + i * 10, float(i)) for i in xrange(10, 20)]
+        self.assertEqual(list(self.series.range(1236735100, 1236735200)), expected)
+        self.client.server_ranges = True
+        self.assertEqual(list(self.series.range(1236735100, 1236735200)), expected)
+        self.assertEqual(self.timetric.requests[-1][1], '/series/s/csv/')
+        self.assertEqual(list(self.series.range(start=1236735985)), [(1236735990.0, 99.0)])
+
+    def test_range_with_datetimes(self):
+        from dateutil import tz
+        start = datetime.datetime.fromtimestamp(1236735100)
+        self.assertEqual(timetric._parse_timestamp(start), 1236735100)
+        self.assertEqual(len(list(self.series.range(start))), 90)
+        end = datetime.datetime(2009, 3, 11, 1, 35, tzinfo=tz.tzutc())
+        self.assertEqual(timetric._parse_timestamp(end), 1236735300)
+        self.assertEqual(len(list(self.series.range(start, end))), 20)
+        end = datetime.datetime(2009, 3, 10, 21, 35, tzinfo=tz.tzoffset(None, -4 * 3600))
+        self.assertEqual(len(list(self.series.range(start, end))), 20)
+
+    def test_resample(self):
+        self.assertEqual(list(self.series.resample(250, 'mean', end=1236735500))[:2],
+                         [(1236735000.0, 12.0), (1236735250.0, 37.0)])
+        self.assertEqual(list(self.series.resample(250, 'min'))[-1], (1236735750.0, 75.0))
+        self.assertEqual(list(self.series.resample(250, 'max'))[-1], (1236735750.0, 99.0))
+        self.assertEqual(len(list(self.series.resample(datetime.timedelta(minutes=10)))), 2)
+
+    def test_resample_nulls(self):
+        points = [(0.0, None), (1.0, 2.0), (2.0, None), (10.0, None)]
+        self.assertEqual(list(timetric._resample(iter(points), 5, 'last')),
+                         [(0.0, 2.0), (10.0, None)])
+
+    def test_resample_bad_agg(self):
+        self.assertRaises(ValueError, self.series.resample, 60, 'median')
+
+class RetryTests(StandInTestCase):
+
+    def setUp(self):
+        super(RetryTests, self).setUp()
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+        self.policy = timetric.RetryPolicy(retries=3, backoff=0,
+                                           failure_threshold=4, reset_timeout=60)
+        self.client = self.timetric.client(retry=self.policy)
+        self.series = self.client.series('s')
+
+    def test_get_is_retried(self):
+        self.timetric.faults = [503, 'drop', 500]
+        self.assertEqual(self.series.latest(), (1236735000.0, 1.0))
+        self.assertEqual(len(self.timetric.requests), 4)
+
+    def test_retries_run_out(self):
+        self.timetric.faults = [503] * 4
+        self.assertRaises(timetric.TimetricClientError, self.series.latest)
+        self.assertEqual(len(self.timetric.requests), 4)
+
+    def test_increment_isnt_retried(self):
+        self.timetric.faults = [503]
+        self.assertRaises(timetric.TimetricClientError, self.series.increment, 1)
+        self.assertEqual(len(self.timetric.requests), 1)
+
+    def test_upload_is_resent_in_full(self):
+        self.policy.retry_methods += ('POST',)
+        self.timetric.faults = [503]
+        self.series.update(StringIO('1236735500,2.5\n'))
+        self.assertEqual(self.timetric.series['s'][-1], (1236735500.0, 2.5))
+
+    def test_circuit_breaker(self):
+        self.timetric.faults = [503] * 4
+        self.assertRaises(timetric.TimetricClientError, self.series.latest)
+        self.assertRaises(timetric.CircuitOpenError, self.series.latest)
+        self.assertEqual(len(self.timetric.requests), 4)
+
+        # Once the timeout's up a trial request is let through.
+        self.policy.breaker.reset_timeout = 0
+        self.assertEqual(self.series.latest(), (1236735000.0, 1.0))
+        self.policy.breaker.reset_timeout = 60
+        self.timetric.faults = [503]
+        self.assertEqual(self.series.latest(), (1236735000.0, 1.0))
+
+    def test_streamed_reads_are_retried(self):
+        self.timetric.faults = [503, 'drop']
+        self.assertEqual(list(self.series), [(1236735000.0, 1.0)])
+        self.assertEqual(len(self.timetric.requests), 3)
+        self.timetric.faults = [503] * 4
+        self.assertRaises(timetric.TimetricClientError, self.series.fetch)
+        self.assertRaises(timetric.CircuitOpenError, list, self.series)
+
+    def test_backoff(self):
+        policy = timetric.RetryPolicy(backoff=1, max_backoff=5)
+        for (attempt, low, high) in [(0, 0.5, 1), (1, 1, 2), (2, 2, 4), (5, 2.5, 5)]:
+            delay = policy.delay(attempt)
+            self.assertTrue(low <= delay <= high, (attempt, delay))
+
+class ObserverTests(StandInTestCase):
+
+    def setUp(self):
+        super(ObserverTests, self).setUp()
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+        self.events = []
+        self.stats = timetric.RequestStats()
+        self.client.add_observer(self.events.append)
+        self.client.add_observer(self.stats)
+
+    def test_events(self):
+        series = self.client.series('s')
+        series.update([(1236735500, 2.0)])
+        series.latest()
+        self.assertRaises(timetric.TimetricClientError, self.client.series('x').csv)
+        list(series)
+
+        update, latest, missing, stream = self.events
+        self.assertEqual(update.endpoint, 'POST /series/<id>/')
+        self.assertEqual(update.series_id, 's')
+        self.assertEqual(update.status, 204)
+        self.assertTrue(update.bytes_sent > 0)
+        self.assertTrue(update.encode_time > 0)
+        self.assertTrue(update.sign_time > 0)
+        self.assertTrue(update.network_time > 0)
+        self.assertEqual(latest.endpoint, 'GET /series/<id>/value/json/')
+        self.assertTrue(latest.bytes_received > 0)
+        self.assertEqual(latest.encode_time, 0)
+        self.assertEqual(missing.status, 404)
+        self.assertEqual(stream.endpoint, 'GET /series/<id>/csv/')
+        self.assertEqual(stream.bytes_received, None)
+
+    def test_errors(self):
+        # httplib2 retries a dropped connection once by itself.
+        self.timetric.faults = ['drop', 'drop']
+        self.assertRaises(Exception, self.client.series('s').latest)
+        self.assertTrue(self.events[0].error is not None)
+        self.assertEqual(self.stats.summary()['GET /series/<id>/value/json/']['errors'], 1)
+
+    def test_stats(self):
+        series = self.client.series('s')
+        for i in xrange(5):
+            series.increment(1)
+        stats = self.stats.summary()['POST /series/<id>/']
+        self.assertEqual(stats['count'], 5)
+        self.assertEqual(stats['statuses'], {204: 5})
+        self.assertEqual(sum(stats['histogram']), 5)
+        self.assertTrue(stats['total_time'] >= stats['network_time'] > 0)
+
+    def test_removing_observers(self):
+        self.client.remove_observer(self.events.append)
+        self.client.remove_observer(self.stats)
+        self.client.series('s').latest()
+        self.assertEqual(self.events, [])
+
+class RateLimiterTests(StandInTestCase):
+
+    def setUp(self):
+        super(RateLimiterTests, self).setUp()
+        self.timetric.series['s'] = [(1236735000.0, 1.0)]
+
+    def limited(self, **kwargs):
+        self.limiter = timetric.RateLimiter(**kwargs)
+        return self.timetric.client(rate_limit=self.limiter)
+
+    def test_request_rate(self):
+        client = self.limited(requests_per_s=20, burst=0.1)
+        stats = timetric.RequestStats()
+        client.add_observer(stats)
+        elapsed = timed(lambda: [client.series('s').latest() for i in xrange(12)])
+        self.assertTrue(elapsed >= 0.45, elapsed)
+        summary = self.limiter.stats()
+        self.assertEqual((summary['reads'], summary['writes']), (12, 0))
+        self.assertTrue(summary['max_queue_time'] > 0.03)
+        self.assertTrue(15 < summary['observed_rate'] < 25, summary['observed_rate'])
+        self.assertTrue(stats.summary()['GET /series/<id>/value/json/']['queue_time'] > 0.3)
+
+    def test_byte_rate(self):
+        client = self.limited(bytes_per_s=50000, burst=0.1)
+        body = '1236735000,1.5\n' * 1000
+        elapsed = timed(lambda: [client.series('s').update(StringIO(body))
+                                 for i in xrange(4)])
+        self.assertTrue(elapsed >= 0.8, elapsed)
+        self.assertEqual(self.limiter.stats()['writes'], 4)
+
+    def test_series_rate(self):
+        client = self.limited(series_requests_per_s=10, burst=0.1)
+        for i in xrange(3):
+            self.timetric.series['s%s' % i] = [(1236735000.0, 1.0)]
+        elapsed = timed(lambda: [client.series('s%s' % i).latest() for i in xrange(3)])
+        self.assertTrue(elapsed < 0.1, elapsed)
+        elapsed = timed(lambda: [client.series('s').latest() for i in xrange(3)])
+        self.assertTrue(elapsed >= 0.18, elapsed)
+
+    def test_retry_after(self):
+        client = self.limited()
+        self.timetric.faults = [(429, '', {'Retry-After': '0.3'})]
+        self.assertRaises(timetric.TimetricClientError, client.series('s').latest)
+        self.assertTrue(self.limiter.stats()['paused'] > 0.2)
+        self.assertTrue(timed(client.series('s').latest) >= 0.25)
+        self.assertEqual(self.limiter.stats()['throttled'], 1)
+
+    def test_throttling_slows_down(self):
+        client = self.limited(requests_per_s=100, min_scale=0.2, recovery=0.1)
+        self.timetric.faults = [503, 503]
+        self.assertRaises(timetric.TimetricClientError, client.series('s').latest)
+        self.assertEqual(self.limiter.stats()['requests_per_s'], 50)
+        # Throttling responses coming in together only slow things once.
+        self.assertRaises(timetric.TimetricClientError, client.series('s').latest)
+        self.assertEqual(self.limiter.stats()['requests_per_s'], 50)
+        client.series('s').latest()
+        self.assertAlmostEqual(self.limiter.stats()['requests_per_s'], 60)
+        self.assertEqual(self.limiter.stats()['throttled'], 2)
+
+    def test_no_rates_pauses(self):
+        client = self.limited(pause=0.2)
+        self.timetric.faults = [503]
+        self.assertRaises(timetric.TimetricClientError, client.series('s').latest)
+        self.assertTrue(timed(client.series('s').latest) >= 0.15)
+
+    def test_retries_are_limited(self):
+        client = self.timetric.client(rate_limit=timetric.RateLimiter(),
+                                      retry=timetric.RetryPolicy(backoff=0))
+        self.timetric.faults = [503, (503, '', {'Retry-After': '0.2'})]
+        self.assertTrue(timed(client.series('s').latest) >= 0.15)
+        self.assertEqual(client.rate_limit.stats()['reads'], 3)
+
+    def test_reads_and_writes_take_turns(self):
+        limiter = timetric.RateLimiter(requests_per_s=50, burst=0.01)
+        order = []
+        def run(method):
+            limiter.acquire(method, 'http://example.com/series/s/')
+            order.append(method)
+        threads = [threading.Thread(target=run, args=('POST',)) for i in xrange(10)]
+        threads += [threading.Thread(target=run, args=('GET',)) for i in xrange(10)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.002)
+        for thread in threads:
+            thread.join()
+        self.assertTrue(order[:10].count('GET') >= 4, order)
+        stats = limiter.stats()
+        self.assertEqual((stats['reads'], stats['writes'], stats['queued']), (10, 10, 0))
+        self.assertTrue(stats['read_queue_time'] > 0 and stats['write_queue_time'] > 0)
+
+    def test_retry_after_dates(self):
+        now = time.time()
+        header = email.utils.formatdate(now + 120, usegmt=True)
+        self.assertTrue(115 < timetric._retry_after(header, now) <= 120)
+        self.assertEqual(timetric._retry_after('30', now), 30)
+        self.assertEqual(timetric._retry_after('soon', now), None)
+
+class ImportTests(unittest.TestCase):
+    """
+    Keeps `import timetric` quick: the slow dependencies should only be
+    imported once they're needed.
+    """
+    LAZY = ['csv', 'dateutil', 'email', 'httplib', 'httplib2', 'json',
+            'oauth', 'simplejson', 'urllib']
+
+    def imported(self, code):
+        """
+        Run `code` in a fresh interpreter, and return which of `LAZY` it
+        imported.
+        """
+        code = "import sys\n%s\nprint ' '.join(m for m in %r if m in sys.modules)" \
+            % (code, self.LAZY)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(timetric.__file__)))
+        output = subprocess.Popen([sys.executable, '-c', code],
+                                  env=dict(os.environ, PYTHONPATH=root),
+                                  stdout=subprocess.PIPE).communicate()[0]
+        return output.split()
+
+    def test_import_is_lazy(self):
+        self.assertEqual(self.imported("import timetric"), [])
+
+    def test_apitoken_client_skips_oauth_and_dateutil(self):
+        imported = self.imported(
+            "import timetric\n"
+            "timetric.TimetricClient({'authtype': 'apitoken', 'apitoken_key': 'k',"
+            " 'apitoken_secret': 's'})")
+        self.assertTrue('httplib2' in imported)
+        self.assertFalse('dateutil' in imported or 'oauth' in imported)
+
+    def test_json_falls_back_to_stdlib(self):
+        imported = self.imported(
+            "sys.modules['simplejson'] = None\n"
+            "import timetric\n"
+            "assert timetric.json.loads('[1.5]') == [1.5]\n"
+            "assert timetric.json.__name__ == 'json'")
+        self.assertTrue('json' in imported)
+
+class SigningTests(unittest.TestCase):
+
+    def test_apitoken_headers(self):
+        client = timetric.TimetricClient({'authtype': 'apitoken',
+                                          'apitoken_key': 'key',
+                                          'apitoken_secret': 'secret'})
+        url, headers = client.sign_request('POST', 'http://example.com/',
+                                           {'value': '1'})
+        self.assertEqual(url, 'http://example.com/?value=1')
+        self.assertEqual(headers['Authorization'], 'Basic a2V5OnNlY3JldA==')
+        self.assertEqual(headers['User-Agent'], 'python-timetric')
+
+        headers['X-Mangled'] = 'yes'
+        url, headers = client.sign_request('GET', 'http://example.com/')
+        self.assertFalse('X-Mangled' in headers)
+
+        client.user_agent = 'my-app/1.0'
+        url, headers = client.sign_request('GET', 'http://example.com/')
+        self.assertEqual(headers['User-Agent'], 'my-app/1.0')
+
+try:
+    from oauth import oauth
+except ImportError:
+    oauth = None
+
+class OAuthSigningTests(unittest.TestCase):
+
+    def setUp(self):
+        if oauth is None:
+            self.skipTest("oauth isn't installed")
+        self.client = timetric.TimetricClient({
+            'authtype': 'oauth',
+            'consumer_key': 'consumer key',
+            'consumer_secret': 'consumer/secret+&~',
+            'oauth_token': 'token key',
+            'oauth_secret': 'token=secret',
+        })
+        self.generate_nonce = oauth.generate_nonce
+        self.generate_timestamp = oauth.generate_timestamp
+        oauth.generate_nonce = lambda: '01234567'
+        oauth.generate_timestamp = lambda: 1236735000
+
+    def tearDown(self):
+        if oauth is not None:
+            oauth.generate_nonce = self.generate_nonce
+            oauth.generate_timestamp = self.generate_timestamp
+
+    def assertSignsLikeOAuth(self, method, url, params):
+        req = self.client.build_oauth_request(method, url, dict(params))
+        signer = timetric._OAuthSigner(self.client.consumer, self.client.access_token)
+        for i in xrange(2):
+            normalized, header = signer.sign(method, url, params,
+                                             '01234567', 1236735000)
+            self.assertEqual(normalized, req.get_normalized_http_url())
+            expected = oauth.OAuthRequest._split_header(req.to_header()['Authorization'])
+            self.assertEqual(oauth.OAuthRequest._split_header(header), expected)
+            self.assertEqual(header.split('oauth_signature="')[1],
+                             oauth.escape(req.get_parameter('oauth_signature')) + '"')
+
+    def test_signatures_match(self):
+        self.assertSignsLikeOAuth('POST', 'http://timetric.com/series/abc/', {'increment': '1'})
+        self.assertSignsLikeOAuth('GET', 'https://timetric.com:443/series/abc/csv/', {})
+        self.assertSignsLikeOAuth('GET', 'http://timetric.com:80/series/a%20b/?x=1',
+                                  {'start': '1236735000.0', 'end': u'\u2603 ~&='})
+        self.assertSignsLikeOAuth('delete', 'http://timetric.com/series/abc/', {})
+
+    def test_sign_request(self):
+        url, headers = self.client.sign_request('GET', 'http://timetric.com/series/abc/',
+                                                {'a': 'b c'})
+        self.assertEqual(url, 'http://timetric.com/series/abc/?a=b+c')
+        req = oauth.OAuthRequest.from_request(
+            'GET', 'http://timetric.com/series/abc/', headers, {'a': 'b c'})
+        self.assertTrue(self.client.SIGNATURE.check_signature(
+            req, self.client.consumer, self.client.access_token,
+            req.get_parameter('oauth_signature')))
+
+    def test_new_token_gets_new_signer(self):
+        self.client.sign_request('GET', 'http://timetric.com/')
+        self.client.access_token = oauth.OAuthToken('other', 'secret')
+        url, headers = self.client.sign_request('GET', 'http://timetric.com/')
+        self.assertTrue('oauth_token="other"' in headers['Authorization'])
+
+class TimestampParserTests(unittest.TestCase):
+
+    def assertParsesLikeDateutil(self, values):
+        parser = timetric._TimestampParser()
+        for value in values:
+            self.assertEqual(parser(value), timetric._parse_timestamp(value))
+
+    def test_iso8601(self):
+        self.assertParsesLikeDateutil([
+            '2009-03-11T01:30:00Z',
+            '2009-03-11T01:30:00+05:30',
+            '2009-03-11T01:30:00.123-0700',
+            '2009-03-11 01:30:00',
+            '2009-03-11T01:30',
+            '2009-07-11',
+        ])
+
+    def test_rfc2822(self):
+        self.assertParsesLikeDateutil([
+            'Wed, 11 Mar 2009 01:30:00 +0000',
+            '11 Mar 2009 01:30 -0500',
+            'Wed, 11 Mar 2009 01:30:00 GMT',
+            'Wed, 11 Mar 2009 01:30:00',
+        ])
+
+    def test_mixed_formats_and_fallback(self):
+        self.assertParsesLikeDateutil([
+            '1236735000',
+            '2009-03-11T01:30:00Z',
+            'March 11, 2009 1:30pm',
+            '1236735000.5',
+            datetime.datetime(2009, 3, 11, 1, 30),
+            1236735000,
+        ])
+
+    def test_time_zones(self):
+        from dateutil import tz
+        parser = timetric._TimestampParser()
+        for value in ['2009-03-11T01:30:00Z', '2009-03-11T02:30:00+01:00',
+                      'Wed, 11 Mar 2009 01:30:00 +0000', '11 Mar 2009 03:30 +0200',
+                      datetime.datetime(2009, 3, 11, 1, 30, tzinfo=tz.tzutc())]:
+            self.assertEqual(parser(value), 1236735000, value)
+        local = datetime.datetime.fromtimestamp(1247275800.25)
+        self.assertEqual(parser(local), 1247275800.25)
+        self.assertEqual(parser(local.strftime('%Y-%m-%dT%H:%M:%S.25')), 1247275800.25)
+
+    def test_format_detection(self):
+        parser = timetric._TimestampParser()
+        parser('2009-03-11T01:30:00Z')
+        self.assertTrue(parser.format is timetric._parse_iso8601)
+        parser('1236735000')
+        self.assertTrue(parser.format is timetric._parse_epoch)
+
+    def test_epoch_millis(self):
+        parser = timetric._TimestampParser()
+        self.assertEqual(parser('1236735000500'), 1236735000.5)
+
+    def test_cache(self):
+        parser = timetric._TimestampParser(cache_size=2)
+        for value in ['2009-03-11', '2009-03-12', '2009-03-13', '2009-03-12']:
+            parser(value)
+        self.assertEqual(len(parser.cache), 2)
+        self.assertFalse('2009-03-11' in parser.cache)
+        self.assertTrue('2009-03-12' in parser.cache)
+
 if __name__ == '__main__':
     import httplib2
     #httplib2.debuglevel = 1
@@ -1,25 +1,161 @@
+import array
 import base64
-import csv
-import dateutil.parser
-import httplib2
-import simplejson
+import binascii
+import bisect
+import calendar
+import copy
+import datetime
+import functools
+import hashlib
+import hmac
+import itertools
+import math
+import mmap
+import os
+import Queue
+import random
+import re
+import stat
+import struct
+import sys
+import tempfile
+import threading
 import time
-import urllib
+import urlparse
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from cStringIO import StringIO
 
+class _LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is first used, then
+    imports it and takes its place in this module's globals.
+
+    Given several names, the first that can be imported is used.
+    """
+    def __init__(self, global_name, *names):
+        self._global_name = global_name
+        self._names = names
+
+    def __getattr__(self, attr):
+        for name in self._names[:-1]:
+            try:
+                module = __import__(name)
+                break
+            except ImportError:
+                pass
+        else:
+            module = __import__(self._names[-1])
+        globals()[self._global_name] = module
+        return getattr(module, attr)
+
+# These are slow to import, and plenty of programs never need them (or need
+# only some), so they're imported when first used. If dateutil or httplib2
+# fail you need to `easy_install python-dateutil` or `easy_install httplib2`;
+# simplejson is optional.
+csv = _LazyModule('csv', 'csv')
+dateutil = _LazyModule('dateutil', 'dateutil.parser')
+email = _LazyModule('email', 'email.utils')
+httplib = _LazyModule('httplib', 'httplib')
+httplib2 = _LazyModule('httplib2', 'httplib2')
+json = _LazyModule('json', 'simplejson', 'json')
+urllib = _LazyModule('urllib', 'urllib')
+
+# How much to read from sockets and files at a time when streaming.
+CHUNK_SIZE = 64 * 1024
+
+# Generated CSV is kept in memory up to this size, then spills to disk.
+SPOOL_SIZE = 1024 * 1024
+
+# How much of a file to memory-map at once when uploading it.
+MMAP_WINDOW = 16 * 1024 * 1024
+
 
 class TimetricClient(object):
     """
     Timetric client. You'll need a config dict; the authenticated token will be
     written back to this dictionary. Obviously you should make this persistant
     in some way to avoid needing to authenticate each time.
+
+    A client can only be used by one thread at a time, unless it's given a
+    `pool_size`: then requests go through an `HttpPool` of up to that many
+    keep-alive connections per host, and many threads can share the client.
+    Streamed reads (`get_stream`, and so iterating over a series, `range`,
+    `resample`, `fetch`, `to_arrays`, `dump` and `SeriesMirror.sync`) don't
+    use the pool: each opens a connection of its own, closed with the
+    response, which doesn't count towards `pool_size`.
+
+    Observers added with `add_observer` are told about every request; see
+    `RequestEvent` and `RequestStats`.
+
+    Given a `retry` policy (see `RetryPolicy`), failed requests are retried
+    and a host that keeps failing is given a rest.
+
+    Given a `rate_limit` (a `RateLimiter`, which may be shared between
+    clients), every request waits for its turn under the limiter's rates,
+    and the limiter backs off when the server says it's overloaded.
+
+    Given a `cache` (a `MemoryCache`, `DiskCache` or anything else with
+    `get`, `set` and `delete` methods), GET responses carrying an ETag or
+    Last-Modified header are kept, and later GETs of the same URL ask the
+    server whether they've changed; an unchanged (304) response is served
+    from the cache. `cache_stats` counts `hits` (served from the cache),
+    `misses` (fetched in full) and `revalidations` (conditional requests).
+
+    Given a `compress_uploads` level (1 to 9), CSV uploads are gzipped at
+    that level and sent with ``Content-Encoding: gzip``; only use it with a
+    server that accepts that.
+
+    `series()` hands out the same `Series` for the same id, keeping up to
+    `max_series_handles` of them (so set `series_url` before using it).
+    Series metadata is cached, up to `metadata_cache_size` series' worth
+    for `metadata_ttl` seconds each, and forgotten when a series is
+    deleted or rewritten; `metadata_stats` counts `hits` and `misses`.
     """
     request_token_url = 'http://timetric.com/oauth/request_token/'
     authorization_url = 'http://timetric.com/oauth/authorize/'
     access_token_url = 'http://timetric.com/oauth/access_token/'
+    series_url = 'http://timetric.com/series/%s/'
+    create_url = 'https://timetric.com/create/'
+
+    # Whether the server can limit a series' CSV to a time range (given as
+    # `start` and `end` parameters). Either way, `Series.range` filters the
+    # points itself too, so this only saves bandwidth.
+    server_ranges = False
+
+    # Whether to ask for gzipped responses to streamed reads (which are
+    # decompressed as they're read). Other requests go through httplib2,
+    # which asks for them itself.
+    gzip_responses = True
+
+    # Seconds a streamed read may wait on the socket before giving up. The
+    # connection's otherwise set up like the client's own, proxy and all.
+    stream_timeout = 60
+
+    # Where a series' metadata is fetched from, relative to its URL.
+    metadata_path = 'metadata/json/'
+
+    max_series_handles = 100000
+    metadata_cache_size = 10000
+    metadata_ttl = 300
     
-    def __init__(self, config, user_agent="python-timetric"):
-        self.http = httplib2.Http()
+    def __init__(self, config, user_agent="python-timetric", pool_size=None,
+                 pool_idle_timeout=60, cache=None, retry=None,
+                 compress_uploads=None, rate_limit=None):
+        self.observers = []
+        self.local = threading.local()
+        self.cache = cache
+        self.cache_stats = {'hits': 0, 'misses': 0, 'revalidations': 0}
+        self.cache_lock = threading.Lock()
+        self.handles = {}
+        self.metadata_cache = _LRUCache(self.metadata_cache_size)
+        self.metadata_stats = {'hits': 0, 'misses': 0}
+        self.metadata_lock = threading.Lock()
+        if pool_size:
+            self.http = HttpPool(pool_size, pool_idle_timeout)
+        else:
+            self.http = _new_http()
         self.http.follow_redirects = False
         self.config = config
         self.user_agent = user_agent
@@ -31,6 +167,15 @@ class TimetricClient(object):
         else:
             raise ValueError("Invalid Timetric auth type: '%s' "
                              "(should be 'oauth' or 'apitoken')" % self.authtype)
+        self.compress_uploads = compress_uploads
+        self.rate_limit = rate_limit
+        if rate_limit is not None:
+            self.make_request = functools.partial(self.limited_request,
+                                                  self.make_request)
+        self.retry = retry
+        if retry is not None:
+            self.make_request = functools.partial(self.retrying_request,
+                                                  self.make_request)
 
     def setup_oauth(self):
         from oauth import oauth # if this fails you need to `easy_install oauth`.
@@ -38,6 +183,8 @@ class TimetricClient(object):
         self.SIGNATURE = oauth.OAuthSignatureMethod_HMAC_SHA1()
         self.authtype = 'oauth'
         self.make_request = self.oauth_request
+        self.sign_request = self.sign_oauth_request
+        self.oauth_signer = None
         try:
             self.consumer = oauth.OAuthConsumer(self.config['consumer_key'], self.config['consumer_secret'])
         except KeyError:
@@ -50,8 +197,13 @@ class TimetricClient(object):
     def setup_apitokens(self):
         self.authtype = 'apitoken'
         self.make_request = self.apitoken_request
+        self.sign_request = self.sign_apitoken_request
         self.apitoken_key = self.config['apitoken_key']
         self.apitoken_secret = self.config['apitoken_secret']
+        self.apitoken_headers = {
+            'Authorization': "Basic %s" % base64.b64encode(
+                "%s:%s" % (self.apitoken_key, self.apitoken_secret)),
+        }
 
     def series(self, id):
         """
@@ -60,7 +212,50 @@ class TimetricClient(object):
         """
         if self.authtype == 'oauth' and not self.access_token:
             raise ValueError("Client isn't yet authorized.")
-        return Series(self, id)
+        try:
+            return self.handles[id]
+        except KeyError:
+            pass
+        if len(self.handles) >= self.max_series_handles:
+            self.handles.popitem()
+        series = self.handles[id] = Series(self, id)
+        return series
+
+    def series_metadata(self, id, refresh=False):
+        """
+        Get a series' metadata (its title, caption, units and so on) as a
+        dict, from the cache if it's there and not too old (or `refresh` is
+        set).
+        """
+        if not refresh:
+            with self.metadata_lock:
+                cached = self.metadata_cache.get(id)
+                if cached is not None and cached[0] > time.time():
+                    self.metadata_stats['hits'] += 1
+                    return dict(cached[1])
+                self.metadata_stats['misses'] += 1
+        resp, body = self.get(self.series_url % id + self.metadata_path)
+        if resp.status != 200:
+            raise TimetricClientError("Failed to fetch metadata: HTTP %s" % resp.status)
+        metadata = json.loads(body)
+        self.remember_metadata(id, metadata)
+        return dict(metadata)
+
+    def remember_metadata(self, id, metadata):
+        """
+        Cache a series' metadata.
+        """
+        with self.metadata_lock:
+            self.metadata_cache[id] = (time.time() + self.metadata_ttl, dict(metadata))
+
+    def forget_series(self, id, handle=False):
+        """
+        Drop a series' cached metadata, and with `handle`, its `Series`.
+        """
+        with self.metadata_lock:
+            self.metadata_cache.pop(id)
+        if handle:
+            self.handles.pop(id, None)
         
     def create_series(self, data=None, **params):
         """
@@ -78,12 +273,183 @@ class TimetricClient(object):
             if _is_file(data):
                 files = {'csv': data}
             else:
-                files = {'csv': _iterable_to_stream(data)}
+                files = {'csv': self.encode_body(_iterable_to_stream, data)}
         else:
             files = {}
             
-        resp, body = self.post('https://timetric.com/create/', params=params, files=files)
-        return Series(self, resp['location'].split('/')[-2])
+        resp, body = self.post(self.create_url, params=params, files=files)
+        id = resp['location'].split('/')[-2]
+        # Not `remember_metadata(id, params)`: the server fills in and
+        # normalises metadata, so what was sent isn't what it holds.
+        return self.series(id)
+
+    def fetch_many(self, ids, what='latest', max_workers=10):
+        """
+        Fetch `what` ('latest' or 'csv') for many series in parallel.
+
+        Returns `(results, errors)`: `results` maps ids to what
+        `Series.latest()` or `Series.csv()` returned, in the order of `ids`,
+        and `errors` maps ids to the exception raised for them. A failure
+        for one series doesn't stop the others.
+
+        The client must be safe to share between threads; if it wasn't given
+        a `pool_size`, an `HttpPool` of `max_workers` connections is set up
+        for it.
+        """
+        ids = list(ids)
+        done = dict((id, (result, error)) for (id, result, error)
+                    in self.fetch_as_completed(ids, what, max_workers))
+        results = OrderedDict()
+        errors = OrderedDict()
+        for id in ids:
+            result, error = done[id]
+            if error is None:
+                results[id] = result
+            else:
+                errors[id] = error
+        return results, errors
+
+    def fetch_as_completed(self, ids, what='latest', max_workers=10):
+        """
+        Like `fetch_many`, but yields `(id, result, error)` for each series as
+        it finishes; exactly one of `result` and `error` is None.
+        """
+        if what not in ('latest', 'csv'):
+            raise ValueError("Can't fetch '%s' (should be 'latest' or 'csv')" % what)
+        self._ensure_pool(max_workers)
+        executor = _Executor(max_workers)
+        finished = Queue.Queue()
+        try:
+            count = 0
+            for id in ids:
+                future = executor.submit(getattr(self.series(id), what))
+                future.add_done_callback(
+                    lambda future, id=id: finished.put((id, future)))
+                count += 1
+            for i in xrange(count):
+                id, future = finished.get()
+                error = future.exception()
+                if error is None:
+                    yield id, future.result(), None
+                else:
+                    yield id, None, error
+        finally:
+            executor.shutdown(wait=False)
+
+    def bulk_update(self, data, max_workers=10, progress=None):
+        """
+        Add data to many series at once.
+
+        `data` maps series ids to an iterable of `(timestamp, value)` pairs
+        or a CSV file, as for `Series.update`; it can also be an iterable of
+        `(id, data)` pairs, which is consumed as the series are sent. Up to
+        `max_workers` series are sent at once. A failure for one series
+        doesn't stop the others.
+
+        Uploads need a Content-Length, so each series' rows are written out
+        as CSV before its request starts: into memory up to `SPOOL_SIZE`
+        bytes, and to a temporary file past that. Only the series being
+        sent are spooled at any one time, so at most `max_workers` of them
+        are held at once; but a big backfill will go through that much
+        memory or disk.
+
+        Returns a `BulkUpdateReport`. If given, `progress(report)` is called
+        from the calling thread each time a series finishes, which is handy
+        for keeping an eye on long backfills.
+
+        As with `fetch_many`, if the client wasn't given a `pool_size`, an
+        `HttpPool` of `max_workers` connections is set up for it.
+        """
+        if hasattr(data, 'iteritems'):
+            data = data.iteritems()
+        self._ensure_pool(max_workers)
+        report = BulkUpdateReport()
+        executor = _Executor(max_workers)
+        finished = Queue.Queue()
+        def collect():
+            report._add(*finished.get())
+            if progress is not None:
+                progress(report)
+        try:
+            pending = 0
+            for (id, series_data) in data:
+                # Only queue up a few series per worker, so that a generator
+                # of them isn't read far ahead of what's been sent.
+                if pending >= max_workers * 2:
+                    collect()
+                    pending -= 1
+                future = executor.submit(
+                    functools.partial(self._bulk_update_series, id, series_data))
+                future.add_done_callback(
+                    lambda future, id=id: finished.put((id, future)))
+                pending += 1
+            for i in xrange(pending):
+                collect()
+        finally:
+            executor.shutdown(wait=False)
+        report.finished = time.time()
+        return report
+
+    def _bulk_update_series(self, id, data):
+        """
+        Send one series' part of a `bulk_update`, returning a dict of the
+        `rows` (None for files), `bytes` and `seconds` it took.
+        """
+        start = time.time()
+        rows = None
+        if not _is_file(data):
+            rows = [0]
+            def counted(data=data):
+                for row in data:
+                    rows[0] += 1
+                    yield row
+            data = self.encode_body(_iterable_to_stream, counted())
+            rows = rows[0]
+        data, size = _sized_file(data)
+        self.series(id)._update_from_file(data)
+        return {'rows': rows, 'bytes': size, 'seconds': time.time() - start}
+
+    def _ensure_pool(self, size):
+        """
+        Make the client safe to share between threads, by giving it an
+        `HttpPool` of `size` connections if it doesn't have a pool already.
+        The old `Http`'s connections are closed.
+        """
+        if not isinstance(self.http, HttpPool):
+            old, pool = self.http, HttpPool(size)
+            pool.follow_redirects = old.follow_redirects
+            self.http = pool
+            _close_http(old)
+
+    def writer(self, max_queued=10000, senders=4, overflow='block'):
+        """
+        Start sending writes from background threads; see `Writer`. Use it
+        as a context manager, or call `close()` when done::
+
+            with client.writer(overflow='drop_oldest') as writer:
+                writer.series(id).update(1.5)
+
+        If the client wasn't given a `pool_size`, an `HttpPool` of `senders`
+        connections is set up for it.
+        """
+        writer = Writer(self, max_queued, senders, overflow)
+        self._ensure_pool(senders)
+        return writer
+
+    def batch(self, max_rows=1000, interval=1.0, max_buffered=100000):
+        """
+        Start buffering writes; see `Batch`. Use it as a context manager, or
+        call `close()` when done::
+
+            with client.batch() as batch:
+                batch.series(id).increment(1)
+
+        If the client wasn't given a `pool_size`, an `HttpPool` of two
+        connections is set up for it, so the flush thread and the caller can
+        both use it.
+        """
+        self._ensure_pool(2)
+        return Batch(self, max_rows, interval, max_buffered)
         
     def get_request_token(self):
         """
@@ -146,7 +512,87 @@ class TimetricClient(object):
         """
         if not params:
             params = {}
-        return self.make_request('GET', url, params=params)
+        if self.cache is None:
+            return self.make_request('GET', url, params=params)
+        return self._cached_get(url, params)
+
+    def _cached_get(self, url, params):
+        key = url
+        if params:
+            key += "?%s" % urllib.urlencode(sorted(params.items()))
+        cached = self.cache.get(key)
+        headers = {}
+        if cached:
+            if 'etag' in cached[0]:
+                headers['If-None-Match'] = cached[0]['etag']
+            if 'last-modified' in cached[0]:
+                headers['If-Modified-Since'] = cached[0]['last-modified']
+        revalidating = bool(headers)
+        resp, body = self.make_request('GET', url, params=params, headers=headers)
+        with self.cache_lock:
+            if revalidating:
+                self.cache_stats['revalidations'] += 1
+            if resp.status == 304 and cached:
+                self.cache_stats['hits'] += 1
+            else:
+                self.cache_stats['misses'] += 1
+        if resp.status == 304 and cached:
+            resp = httplib2.Response(cached[0])
+            resp.fromcache = True
+            return resp, cached[1]
+        if resp.status == 200 and ('etag' in resp or 'last-modified' in resp):
+            self.cache.set(key, (dict(resp), body))
+        elif cached:
+            self.cache.delete(key)
+        return resp, body
+
+    def get_stream(self, url, params=None, headers=None):
+        """
+        Make an authorized HTTP GET request without reading the response body.
+
+        Returns an unread `httplib.HTTPResponse`; read the body off the socket
+        with `read(n)` and `close()` it when done. A gzipped body is
+        decompressed as it's read.
+
+        Given a `retry` policy, the request is retried as `make_request`'s
+        are, up to the point the response status arrives; once the body is
+        being read, errors are the caller's.
+        """
+        if self.gzip_responses:
+            headers = dict(headers or {})
+            headers['Accept-Encoding'] = 'gzip'
+        if self.retry is None:
+            return self.stream_request('GET', url, params, headers=headers)[0]
+        return self.retrying_request(self.stream_request, 'GET', url, params,
+                                     headers=headers)[0]
+
+    def stream_request(self, method, url, params=None, body="", headers=None):
+        """
+        Sign and send a request without reading the response body. Returns
+        `(response, None)`, to match `make_request`.
+        """
+        queue_time = 0.0
+        if self.rate_limit is not None:
+            queue_time = self.rate_limit.acquire(method, url)
+        if self.observers:
+            event = RequestEvent(method, url)
+            event.queue_time = queue_time
+            start = time.time()
+        url, headers = self.sign_request(method, url, params=params, headers=headers)
+        if not self.observers:
+            return self._limited(_decoded(self._open_stream(method, url, body, headers))), None
+        signed = time.time()
+        event.sign_time = signed - start
+        try:
+            resp = self._limited(_decoded(self._open_stream(method, url, body, headers)))
+            event.status = resp.status
+            return resp, None
+        except Exception, e:
+            event.error = e
+            raise
+        finally:
+            event.network_time = time.time() - signed
+            self.notify(event)
         
     def delete(self, url, params=None):
         """
@@ -167,8 +613,10 @@ class TimetricClient(object):
         if not files:
             files = {}
         if files:
-            body = _encode_multipart(params, files)
             headers = {'Content-Type':MULTIPART_CONTENT}
+            body = self.compress_body(
+                self.encode_body(_encode_multipart, params, files), headers)
+            headers['Content-Length'] = str(len(body))
         else:
             body = urllib.urlencode(params)
             headers = {'Content-Type': 'application/x-www-form-urlencoded'}
@@ -181,30 +629,178 @@ class TimetricClient(object):
         Returns `(response_headers, body)`
         """
         headers = {'Content-Type':content_type}
+        if isinstance(body, BodyStream):
+            body = self.compress_body(body, headers)
         return self.make_request('PUT', url, body=body, headers=headers)
 
+    def compress_body(self, body, headers):
+        """
+        Gzip a `BodyStream` if the client compresses uploads, adding the
+        Content-Encoding to `headers`. Returns the body to send.
+        """
+        if not self.compress_uploads:
+            return body
+        headers['Content-Encoding'] = 'gzip'
+        return self.encode_body(_gzip_body, body, self.compress_uploads)
+
     def oauth_request(self, method, url, params=None, body="", headers=None):
+        if self.observers:
+            return self.observed_request(self.sign_oauth_request, method, url,
+                                         params, body, headers)
+        url, headers = self.sign_oauth_request(method, url, params, headers)
+        return self.http.request(url, method, body=body, headers=headers)
+
+    def apitoken_request(self, method, url, params=None, body="", headers=None):
+        if self.observers:
+            return self.observed_request(self.sign_apitoken_request, method, url,
+                                         params, body, headers)
+        url, headers = self.sign_apitoken_request(method, url, params, headers)
+        return self.http.request(url, method, body=body, headers=headers)
+
+    def _open_stream(self, method, url, body, headers):
+        return _open_stream(method, url, body or None, headers, self.http,
+                            self.stream_timeout)
+
+    def _limited(self, resp):
+        # Tell the rate limiter how a streamed request went.
+        if self.rate_limit is not None:
+            self.rate_limit.feedback(resp.status, resp.getheader('retry-after'))
+        return resp
+
+    def add_observer(self, observer):
+        """
+        Call `observer(event)` with a `RequestEvent` after every request.
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, event):
+        for observer in self.observers:
+            observer(event)
+
+    def encode_body(self, encode, *args):
+        """
+        Build a request body with `encode(*args)`, timing it for observers;
+        the time is reported with the thread's next request.
+        """
+        if not self.observers:
+            return encode(*args)
+        start = time.time()
+        try:
+            return encode(*args)
+        finally:
+            self.local.encode_time = (getattr(self.local, 'encode_time', 0.0)
+                                      + time.time() - start)
+
+    def observed_request(self, sign, method, url, params=None, body="", headers=None):
+        """
+        Sign (with `sign`) and send a request, timing each step and telling
+        the observers about it.
+        """
+        event = RequestEvent(method, url)
+        event.encode_time = getattr(self.local, 'encode_time', 0.0)
+        event.queue_time = getattr(self.local, 'queue_time', 0.0)
+        self.local.encode_time = self.local.queue_time = 0.0
+        event.bytes_sent = body and len(body) or 0
+        start = time.time()
+        url, headers = sign(method, url, params, headers)
+        signed = time.time()
+        event.sign_time = signed - start
+        try:
+            resp, content = self.http.request(url, method, body=body, headers=headers)
+            event.status = resp.status
+            event.bytes_received = len(content)
+            return resp, content
+        except Exception, e:
+            event.error = e
+            raise
+        finally:
+            event.network_time = time.time() - signed
+            self.notify(event)
+
+    def limited_request(self, request, method, url, params=None, body="", headers=None):
+        """
+        Make a request with `request` (an `oauth_request` or
+        `apitoken_request`) once the client's `rate_limit` lets it through,
+        and tell the limiter how it went.
+        """
+        limiter = self.rate_limit
+        queue_time = limiter.acquire(method, url, body and len(body) or 0)
+        if self.observers:
+            self.local.queue_time = queue_time
+        resp, content = request(method, url, params=params, body=body, headers=headers)
+        limiter.feedback(resp.status, resp.get('retry-after'), len(content))
+        return resp, content
+
+    def retrying_request(self, request, method, url, params=None, body="", headers=None):
+        """
+        Make a request with `request` (an `oauth_request`,
+        `apitoken_request` or `stream_request`), retrying failures as the
+        client's `retry` policy allows.
+        """
+        policy = self.retry
+        host = urlparse.urlsplit(url)[1]
+        attempt = 0
+        while True:
+            policy.breaker.before(host)
+            if attempt and hasattr(body, 'rewind'):
+                body.rewind()
+            try:
+                resp, content = request(method, url, params=params, body=body,
+                                        headers=headers)
+            except policy.errors:
+                policy.breaker.failure(host)
+                if not policy.should_retry(method, attempt):
+                    raise
+            else:
+                if resp.status not in policy.retry_statuses:
+                    policy.breaker.success(host)
+                    return resp, content
+                policy.breaker.failure(host)
+                if not policy.should_retry(method, attempt):
+                    return resp, content
+                if content is None:
+                    # A streamed response; let go of its connection.
+                    resp.close()
+            policy.sleep(policy.delay(attempt))
+            attempt += 1
+
+    def sign_oauth_request(self, method, url, params=None, headers=None):
+        """
+        Sign a request with OAuth. Returns `(url, headers)`.
+        """
         if not params:
             params = {}
         if not headers:
             headers = {}
-        req = self.build_oauth_request(method, url, params)
-        headers.update(req.to_header())
+        if not self.access_token:
+            raise ValueError("Client isn't yet authorized.")
+        # The same signature as build_oauth_request would make, but quicker.
+        signer = self.oauth_signer
+        if signer is None or signer.token is not self.access_token:
+            signer = self.oauth_signer = _OAuthSigner(
+                self.consumer, self.access_token, self.oauth_module.OAuthRequest.version)
+        url, headers['Authorization'] = signer.sign(method, url, params)
         headers['User-Agent'] = self.user_agent
-        return self.http.request(req.get_normalized_http_url(),
-                                 method, body=body, headers=headers)
+        if params and method in ('GET', 'DELETE'):
+            # POSTed parameters go in the body.
+            url += "?%s" % urllib.urlencode(params)
+        return url, headers
 
-    def apitoken_request(self, method, url, params=None, body="", headers=None):
-        if not headers:
-            headers = {}
+    def sign_apitoken_request(self, method, url, params=None, headers=None):
+        """
+        Sign a request with the API token. Returns `(url, headers)`.
+        """
+        if headers:
+            headers.update(self.apitoken_headers)
+        else:
+            headers = self.apitoken_headers.copy()
+        headers['User-Agent'] = self.user_agent
         if params:
             url += "?%s" % urllib.urlencode(params)
-        auth_header = "Basic %s" % \
-            base64.b64encode("%(apitoken_key)s:%(apitoken_secret)s" %
-                             self.__dict__)
-        headers['Authorization'] = auth_header
-        headers['User-Agent'] = self.user_agent
-        return self.http.request(url, method, body=body, headers=headers)
+        return url, headers
 
 
 class Series(object):
@@ -213,15 +809,23 @@ class Series(object):
     
     Don't create directly; use TimetricClient.series().
     """
+    __slots__ = ('client', 'id', 'url')
     
     def __init__(self, client, id):
         self.client = client
         self.id = id
-        self.url = 'http://timetric.com/series/%s/' % self.id
+        self.url = client.series_url % self.id
     
     def __repr__(self):
         return "<timetric.Series('%s')>" % self.id
     
+    def metadata(self, refresh=False):
+        """
+        Get this series' metadata as a dict; see
+        `TimetricClient.series_metadata`.
+        """
+        return self.client.series_metadata(self.id, refresh)
+
     def latest(self):
         """
         Get the latest value in this series. Returns a tuple `(timestamp,
@@ -230,7 +834,7 @@ class Series(object):
         resp, body = self.client.get(self.url + "value/json/")
         if resp.status != 200:
             raise TimetricClientError("Failed to fetch latest value: HTTP %s" % resp.status)
-        data = simplejson.loads(body)
+        data = json.loads(body)
         return (data['timestamp'], data['value'])
         
     def csv(self):
@@ -243,11 +847,157 @@ class Series(object):
         return body
         
     def __iter__(self):
-        return (
-            (float(ts), _valueish(val))
-            for (ts, val) in csv.reader(StringIO(self.csv()))
-        )
+        return self.iter_stream()
+
+    def iter_stream(self, chunk_size=CHUNK_SIZE, params=None):
+        """
+        Iterate over the series' `(timestamp, value)` pairs as they arrive.
+
+        The CSV is read off the socket `chunk_size` bytes at a time and parsed
+        as it comes in, so memory use doesn't depend on the size of the
+        series.
+        """
+        with self._csv_stream(params) as resp:
+            for (ts, val) in csv.reader(_iter_lines(resp, chunk_size)):
+                yield (float(ts), _valueish(val))
+
+    @contextmanager
+    def _csv_stream(self, params=None, headers=None):
+        """
+        Stream the series' CSV: a context manager giving the unread response,
+        which is closed on the way out. Fails unless the status is 200 (or a
+        304, which only a conditional request gets back).
+        """
+        resp = self.client.get_stream(self.url + "csv/", params=params,
+                                      headers=headers)
+        try:
+            if resp.status not in (200, 304):
+                raise TimetricClientError("Failed to fetch CSV: HTTP %s" % resp.status)
+            yield resp
+        finally:
+            resp.close()
+
+    def range(self, start=None, end=None):
+        """
+        Iterate over the `(timestamp, value)` pairs with `start <= timestamp <
+        end`. Either bound may be None, and may be given in any form
+        `update` understands.
+
+        If the client's `server_ranges` is set the server is asked for just
+        that range; otherwise the whole series is streamed and filtered.
+        """
+        params = {}
+        if start is not None:
+            start = params['start'] = _parse_timestamp(start)
+        if end is not None:
+            end = params['end'] = _parse_timestamp(end)
+        if not self.client.server_ranges:
+            params = None
+        for (ts, value) in self.iter_stream(params=params):
+            if (start is None or ts >= start) and (end is None or ts < end):
+                yield (ts, value)
+
+    def resample(self, bucket, agg='mean', start=None, end=None):
+        """
+        Iterate over the series (or the part of it from `start` to `end`, as
+        for `range`) in buckets of `bucket` seconds (or a `timedelta`),
+        yielding `(bucket start, aggregate)` for each non-empty bucket.
+
+        `agg` may be 'mean', 'min', 'max' or 'last'; null values are skipped,
+        and a bucket of nothing but nulls has a None aggregate. The series is
+        read in a single pass in constant memory, which relies on it being in
+        time order (as Timetric returns it).
+        """
+        if isinstance(bucket, datetime.timedelta):
+            bucket = bucket.days * 86400 + bucket.seconds + bucket.microseconds / 1e6
+        if bucket <= 0:
+            raise ValueError("Bucket size must be positive")
+        if agg not in ('mean', 'min', 'max', 'last'):
+            raise ValueError("Invalid aggregate: '%s' "
+                             "(should be 'mean', 'min', 'max' or 'last')" % agg)
+        return _resample(self.range(start, end), bucket, agg)
     
+    def fetch(self, chunk_size=CHUNK_SIZE):
+        """
+        Get the whole series as a `SeriesData`.
+
+        Like iterating over the series this streams the CSV, but the points
+        go straight into `SeriesData`'s arrays rather than into a tuple each.
+        """
+        data = SeriesData()
+        with self._csv_stream() as resp:
+            for block in _iter_blocks(resp, chunk_size):
+                data.extend_csv(block)
+        return data
+
+    def to_arrays(self, chunk_size=CHUNK_SIZE):
+        """
+        Get the whole series as a pair of NumPy arrays `(timestamps, values)`.
+
+        Both arrays are float64; null values come back as NaN. The CSV is
+        parsed a block at a time with NumPy rather than row by row.
+        """
+        import numpy # if this fails you need to `easy_install numpy`.
+        with self._csv_stream() as resp:
+            blocks = [_block_to_array(numpy, block)
+                      for block in _iter_blocks(resp, chunk_size)]
+        if blocks:
+            flat = numpy.concatenate(blocks)
+        else:
+            flat = numpy.empty(0, dtype=numpy.float64)
+        return flat[0::2].copy(), flat[1::2].copy()
+
+    def update_arrays(self, timestamps, values):
+        """
+        Update the series from a pair of equal-length arrays (or sequences).
+
+        Timestamps may be Unix timestamps or NumPy datetime64 values; NaN
+        values are sent as nulls. The CSV is formatted in bulk rather than a
+        row at a time.
+
+        datetime64 values have no time zone, so like naive datetimes given
+        to `update` they're taken to be in local time.
+        """
+        import numpy # if this fails you need to `easy_install numpy`.
+        timestamps = numpy.asarray(timestamps)
+        if timestamps.dtype.kind == 'M':
+            timestamps = _local_to_epoch(
+                timestamps.astype('datetime64[us]').astype(numpy.int64) / 1e6)
+        timestamps = timestamps.astype(numpy.float64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if timestamps.shape != values.shape or timestamps.ndim != 1:
+            raise ValueError("Timestamps and values must be 1-d arrays of the same length")
+        if numpy.isnan(timestamps).any():
+            raise ValueError("Timestamps can't be NaN")
+        self._update_from_file(
+            self.client.encode_body(_arrays_to_stream, timestamps, values))
+
+    def sync(self, mirror):
+        """
+        Bring this series' copy in a `SeriesMirror` up to date, and return the
+        number of points added.
+        """
+        return mirror.sync(self)
+
+    def dump(self, path, compress=None, chunk_size=CHUNK_SIZE, block_size=None):
+        """
+        Save the whole series to `path` as a `SeriesSnapshot`, zlib-compressed
+        at level `compress` if it's given and in blocks of `block_size`
+        points (`SeriesSnapshot.block_size` by default), and return the
+        snapshot.
+
+        The CSV is streamed straight into the file a block at a time, so
+        memory use doesn't depend on the size of the series.
+        """
+        with self._csv_stream() as resp:
+            return SeriesSnapshot.from_csv(path, resp, compress, chunk_size, block_size)
+
+    def load(self, path):
+        """
+        Rewrite the series with the data in the `SeriesSnapshot` at `path`.
+        """
+        self.rewrite(self.client.encode_body(SeriesSnapshot(path).to_csv))
+
     def __float__(self):
         return float(self.latest()[1])
         
@@ -279,7 +1029,7 @@ class Series(object):
             self._update_single(value)
         else:
             if not _is_file(value):
-                value = _iterable_to_stream(value)
+                value = self.client.encode_body(_iterable_to_stream, value)
             self._update_from_file(value)
                 
     def increment(self, amount):
@@ -306,10 +1056,11 @@ class Series(object):
         The data can be an iterator or a file as for `update`.
         """
         if not _is_file(data):
-            data = _iterable_to_stream(data)
-        resp, _ = self.client.put(self.url, data.read(), 'text/csv')
+            data = self.client.encode_body(_iterable_to_stream, data)
+        resp, _ = self.client.put(self.url, BodyStream([data]), 'text/csv')
         if resp.status != 204:
             raise TimetricClientError("Failed to rewrite data: HTTP %s" % resp.status)
+        self.client.forget_series(self.id)
                                 
     def delete(self):
         """
@@ -318,6 +1069,7 @@ class Series(object):
         resp, _ = self.client.delete(self.url)
         if resp.status != 204:
             raise TimetricClientError("Failed to delete series: HTTP %s" % resp.status)
+        self.client.forget_series(self.id, handle=True)
         
     def _update_single(self, value):
         """
@@ -338,71 +1090,2505 @@ class Series(object):
 class TimetricClientError(Exception):
     pass
 
-def _iterable_to_stream(values):
+class AsyncTimetricClient(object):
     """
-    Convert an iterable of 2-tuples into a file-like object for the dataset.
+    A non-blocking counterpart to `TimetricClient`.
+
+    Calls return a `Future` straight away and run on a fixed pool of
+    `max_concurrency` worker threads, each with its own `TimetricClient`
+    (and so its own connections), which bounds how many requests are in
+    flight at once however many series are being polled.
+
+    Takes the same config dict as `TimetricClient`, and signs requests the
+    same way; a `rate_limit` is shared by all the workers. Call `close()`
+    when done with it.
     """
-    io = StringIO()
-    writer = csv.writer(io)
-    for timestamp, value in values:
-        writer.writerow([_parse_timestamp(timestamp), value])
-    io.seek(0)
-    return io
-    
-def _parse_timestamp(timestamp):
+    series_url = TimetricClient.series_url
+    create_url = TimetricClient.create_url
+
+    def __init__(self, config, user_agent="python-timetric", max_concurrency=10,
+                 rate_limit=None):
+        self.config = config
+        self.user_agent = user_agent
+        self.rate_limit = rate_limit
+        # Build one client up front so a bad config fails here rather than
+        # in a worker thread.
+        TimetricClient(config, user_agent)
+        self.local = threading.local()
+        self.executor = _Executor(max_concurrency)
+
+    def client(self):
+        """
+        Get the calling worker thread's `TimetricClient`.
+        """
+        try:
+            return self.local.client
+        except AttributeError:
+            client = TimetricClient(self.config, self.user_agent,
+                                    rate_limit=self.rate_limit)
+            client.series_url = self.series_url
+            client.create_url = self.create_url
+            self.local.client = client
+            return client
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run `func(client, *args, **kwargs)` on a worker thread with that
+        thread's `TimetricClient`. Returns a `Future`.
+        """
+        return self.executor.submit(
+            lambda: func(self.client(), *args, **kwargs))
+
+    def series(self, id):
+        """
+        Get an `AsyncSeries` for an existing data series.
+        """
+        return AsyncSeries(self, id)
+
+    def create_series(self, data=None, **params):
+        """
+        Create a new series; see `TimetricClient.create_series`. The `Future`
+        resolves to an `AsyncSeries`.
+        """
+        return self.submit(
+            lambda client: AsyncSeries(self, client.create_series(data, **params).id))
+
+    def close(self, wait=True):
+        """
+        Stop the worker threads once queued calls have finished.
+        """
+        self.executor.shutdown(wait)
+
+class AsyncSeries(object):
     """
-    Parse a timestamp into a format that Timetric understands.
+    A Timetric data series whose methods return `Future`s.
+
+    Don't create directly; use AsyncTimetricClient.series().
     """
-    if hasattr(timestamp, 'timetuple'):
-        return time.mktime(timestamp.utctimetuple())
-    try:
-        return float(timestamp)
-    except (TypeError, ValueError):
-        return time.mktime(dateutil.parser.parse(timestamp).utctimetuple())
+    def __init__(self, client, id):
+        self.client = client
+        self.id = id
 
-def _valueish(val):
+    def __repr__(self):
+        return "<timetric.AsyncSeries('%s')>" % self.id
+
+    def _call(self, method, *args):
+        return self.client.submit(
+            lambda client: getattr(client.series(self.id), method)(*args))
+
+    def latest(self):
+        return self._call('latest')
+
+    def csv(self):
+        return self._call('csv')
+
+    def fetch(self):
+        """
+        Get the whole series as a list of `(timestamp, value)` pairs.
+        """
+        return self.client.submit(lambda client: list(client.series(self.id)))
+
+    def update(self, value):
+        return self._call('update', value)
+
+    def increment(self, amount):
+        return self._call('increment', amount)
+
+    def rewrite(self, data):
+        return self._call('rewrite', data)
+
+    def delete(self):
+        return self._call('delete')
+
+class BulkUpdateReport(object):
     """
-    Try to convert something Timetric sent back to a Python value.
+    How a `TimetricClient.bulk_update` went, so far or in the end.
+
+    `results` maps the ids of the series updated to dicts of the `rows` sent
+    (None for files), the `bytes` of CSV sent and the `seconds` it took;
+    `errors` maps the ids of series that failed to the exception raised.
+    Both are in the order the series finished. `rows` and `bytes` are the
+    totals sent, and `rows_per_s` and `mb_per_s` the throughput since the
+    start.
     """
-    literals = {"null":None, "true":True, "false":False}
-    v = val.lower()
-    return v in literals and literals[v] or float(v)
+    def __init__(self):
+        self.results = OrderedDict()
+        self.errors = OrderedDict()
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.finished = None
 
-#
-# The following code is adapted from Django (django.test.client)
-#
-BOUNDARY = 'tHiSiStHeBoUnDaRyStRiNg'
-MULTIPART_CONTENT = 'multipart/form-data; boundary=%s' % BOUNDARY
+    def __repr__(self):
+        return "<timetric.BulkUpdateReport: %s updated, %s failed>" % (
+            len(self.results), len(self.errors))
 
-# Kind ghetto, but works.
-def _is_file(thing): 
-    return hasattr(thing, "read") and callable(thing.read)
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
 
-def _encode_multipart(data, files):
+    @property
+    def rows_per_s(self):
+        return self.rows / max(self.elapsed, 1e-6)
+
+    @property
+    def mb_per_s(self):
+        return self.bytes / (1024.0 * 1024.0) / max(self.elapsed, 1e-6)
+
+    def _add(self, id, future):
+        error = future.exception()
+        if error is not None:
+            self.errors[id] = error
+            return
+        result = self.results[id] = future.result()
+        self.rows += result['rows'] or 0
+        self.bytes += result['bytes']
+
+class Batch(object):
     """
-    Encodes multipart POST data from a dictionary of form values.
+    Buffers series writes and sends them in bulk from a background thread.
+
+    Increments to a series are added up, and single-value updates are kept
+    with the time they were made and sent as one CSV upload per series. A
+    flush happens every `interval` seconds, or sooner once `max_rows` writes
+    are waiting; once `max_buffered` are waiting, writers block until the
+    flush has caught up.
+
+    Only the flush thread sends the buffered writes, so buffered series can
+    be written to from any thread. Errors from a flush are raised from the
+    next `flush()` or `close()`.
+
+    Don't create directly; use TimetricClient.batch().
     """
-    lines = []
-
-    for (key, value) in data.items():
-        lines.extend([
-            '--' + BOUNDARY,
-            'Content-Disposition: form-data; name="%s"' % str(key),
-            '',
-            str(value)
-        ])
-    for (key, value) in files.items():
-        lines.extend([
-            '--' + BOUNDARY,
-            'Content-Disposition: form-data; name="%s"; filename="%s"' \
-                % (str(key), str(key)),
-            'Content-Type: application/octet-stream',
-            '',
-            value.read()
-        ])
-
-    lines.extend([
-        '--' + BOUNDARY + '--',
-        '',
-    ])
-    return '\r\n'.join(lines)
+    def __init__(self, client, max_rows=1000, interval=1.0, max_buffered=100000):
+        self.client = client
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_buffered = max_buffered
+        self.pending = {}
+        self.buffered = 0
+        self.errors = []
+        self.closed = False
+        self.flush_requested = 0
+        self.flush_done = 0
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def series(self, id):
+        """
+        Get a `BufferedSeries` that writes through this batch.
+        """
+        return BufferedSeries(self, id)
+
+    def add(self, id, kind, value, count=1):
+        """
+        Queue a write. `kind` is 'rows' (value is a list of `(timestamp,
+        value)` pairs) or 'increment' (value is the amount).
+
+        Consecutive writes of the same kind to a series are merged; the
+        order of the rest is kept.
+        """
+        with self.lock:
+            if self.closed:
+                raise TimetricClientError("Batch is closed")
+            while self.buffered >= self.max_buffered and not self.closed:
+                self.flush_requested += 1
+                self.lock.notify_all()
+                self.lock.wait()
+            if self.closed:
+                raise TimetricClientError("Batch is closed")
+            segments = self.pending.setdefault(id, [])
+            if segments and segments[-1][0] == kind:
+                if kind == 'rows':
+                    segments[-1][1].extend(value)
+                else:
+                    segments[-1][1] += value
+            else:
+                segments.append([kind, value])
+            self.buffered += count
+            if self.buffered >= self.max_rows:
+                self.flush_requested += 1
+                self.lock.notify_all()
+
+    def flush(self):
+        """
+        Send everything buffered so far, and wait for it to be sent.
+        """
+        with self.lock:
+            self.flush_requested += 1
+            target = self.flush_requested
+            self.lock.notify_all()
+            while self.flush_done < target and self.thread.is_alive():
+                self.lock.wait()
+        self._raise_errors()
+
+    def close(self):
+        """
+        Flush, then stop the background thread.
+        """
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.lock.notify_all()
+        self.thread.join()
+        self._raise_errors()
+
+    def _raise_errors(self):
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not (self.closed or self.flush_requested > self.flush_done):
+                    self.lock.wait(self.interval)
+                pending, self.pending = self.pending, {}
+                target = self.flush_requested
+                closed = self.closed
+            self._send(pending)
+            with self.lock:
+                self.buffered = 0
+                for segments in self.pending.values():
+                    for (kind, value) in segments:
+                        self.buffered += kind == 'rows' and len(value) or 1
+                self.flush_done = target
+                self.lock.notify_all()
+            if closed:
+                return
+
+    def _send(self, pending):
+        for (id, segments) in pending.items():
+            series = self.client.series(id)
+            for (kind, value) in segments:
+                try:
+                    if kind == 'rows':
+                        series._update_from_file(
+                            self.client.encode_body(_iterable_to_stream, value))
+                    elif value:
+                        series.increment(value)
+                except Exception, e:
+                    with self.lock:
+                        self.errors.append(e)
+
+class Writer(object):
+    """
+    Sends series writes from a pool of background threads, so writing never
+    waits on the network.
+
+    Up to `max_queued` writes wait in the queue for one of `senders`
+    threads. All the writes to a series go through the same thread, so they
+    are sent in the order they were made; a run of queued writes of the
+    same kind to one series goes out as one request. When the queue is
+    full, `overflow` decides what happens: 'block' waits for room,
+    'drop_oldest' discards the oldest queued write to make room, and
+    'drop_newest' discards the new write.
+
+    `stats()` reports the queue depth, drops, failures and timings.
+    `close()` sends everything queued and then stops the threads. The first
+    error from a send is raised from the next `flush()` or `close()`.
+
+    Don't create directly; use TimetricClient.writer().
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, client, max_queued=10000, senders=4, overflow='block'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow should be one of %s, not '%s'"
+                             % (', '.join(self.OVERFLOW_POLICIES), overflow))
+        if max_queued < 1:
+            raise ValueError("max_queued should be at least 1, not %s" % max_queued)
+        if senders < 1:
+            raise ValueError("Need at least one sender")
+        self.client = client
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.queues = [deque() for i in xrange(senders)]
+        self.queued = self.max_depth = 0
+        self.sending = 0
+        self.sequence = 0
+        self.counts = dict.fromkeys(('enqueued', 'dropped', 'sent', 'failed', 'requests'), 0)
+        self.send_time = self.max_send_time = 0.0
+        self.lag = self.max_lag = 0.0
+        self.error = None
+        self.closed = False
+        self.lock = threading.Condition()
+        self.threads = []
+        for queue in self.queues:
+            thread = threading.Thread(target=self._run, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def series(self, id):
+        """
+        Get a `BufferedSeries` that writes through this writer.
+        """
+        return BufferedSeries(self, id)
+
+    def add(self, id, kind, value, count=1):
+        """
+        Queue a write. `kind` is 'rows' (value is a list of `(timestamp,
+        value)` pairs) or 'increment' (value is the amount). `count` is
+        accepted for compatibility with `Batch.add`; the queue is bounded
+        in writes, not rows.
+        """
+        with self.lock:
+            if self.closed:
+                raise TimetricClientError("Writer is closed")
+            if self.queued >= self.max_queued:
+                if self.overflow == 'drop_newest':
+                    self.counts['dropped'] += 1
+                    return
+                elif self.overflow == 'drop_oldest':
+                    # Each queue is in order, so the oldest write is at the
+                    # head of one of them.
+                    queue = min((q for q in self.queues if q), key=lambda q: q[0][0])
+                    queue.popleft()
+                    self.queued -= 1
+                    self.counts['dropped'] += 1
+                else:
+                    while self.queued >= self.max_queued and not self.closed:
+                        self.lock.wait()
+                    if self.closed:
+                        raise TimetricClientError("Writer is closed")
+            self.sequence += 1
+            queue = self.queues[hash(id) % len(self.queues)]
+            queue.append((self.sequence, time.time(), id, kind, value))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, self.queued)
+            self.counts['enqueued'] += 1
+            self.lock.notify_all()
+
+    def flush(self):
+        """
+        Wait for everything queued so far to be sent.
+        """
+        with self.lock:
+            while (self.queued or self.sending) and any(t.is_alive() for t in self.threads):
+                self.lock.wait()
+        self._raise_error()
+
+    def close(self):
+        """
+        Send everything queued, then stop the sender threads.
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self._raise_error()
+
+    def stats(self):
+        """
+        Return a dict of: the current queue `depth` and its `max_depth`;
+        counts of writes `enqueued`, `dropped`, `sent` and `failed`, and of
+        `requests` made; and the mean and max seconds a request took
+        (`mean_send_time`, `max_send_time`) and a write took from being
+        queued to being sent (`mean_lag`, `max_lag`).
+        """
+        with self.lock:
+            stats = dict(self.counts, depth=self.queued, max_depth=self.max_depth,
+                         max_send_time=self.max_send_time, max_lag=self.max_lag)
+            written = self.counts['sent'] + self.counts['failed']
+            stats['mean_send_time'] = self.send_time / (self.counts['requests'] or 1)
+            stats['mean_lag'] = self.lag / (written or 1)
+            return stats
+
+    def _raise_error(self):
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _run(self, queue):
+        while True:
+            with self.lock:
+                while not queue and not self.closed:
+                    self.lock.wait()
+                if not queue:
+                    return
+                writes = [queue.popleft()]
+                while queue and queue[0][2:4] == writes[0][2:4]:
+                    writes.append(queue.popleft())
+                self.queued -= len(writes)
+                self.sending += 1
+                self.lock.notify_all()
+            try:
+                self._send(writes)
+            finally:
+                with self.lock:
+                    self.sending -= 1
+                    self.lock.notify_all()
+
+    def _send(self, writes):
+        id, kind = writes[0][2:4]
+        error = None
+        start = time.time()
+        try:
+            series = self.client.series(id)
+            if kind == 'rows':
+                rows = [row for write in writes for row in write[4]]
+                series._update_from_file(
+                    self.client.encode_body(_iterable_to_stream, rows))
+            else:
+                amount = sum(write[4] for write in writes)
+                if amount:
+                    series.increment(amount)
+        except Exception, e:
+            error = e
+        finished = time.time()
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts[error is None and 'sent' or 'failed'] += len(writes)
+            if error is not None and self.error is None:
+                self.error = error
+            self.send_time += finished - start
+            self.max_send_time = max(self.max_send_time, finished - start)
+            for write in writes:
+                self.lag += finished - write[1]
+            self.max_lag = max(self.max_lag, finished - writes[0][1])
+
+class BufferedSeries(object):
+    """
+    A write-only view of a series whose writes go through a `Batch` or a
+    `Writer`.
+
+    Don't create directly; use Batch.series() or Writer.series().
+    """
+    def __init__(self, batch, id):
+        self.batch = batch
+        self.id = id
+
+    def __repr__(self):
+        return "<timetric.BufferedSeries('%s')>" % self.id
+
+    def update(self, value):
+        """
+        Queue an update: a single number (timestamped now) or an iterable of
+        `(datetime, value)` pairs, as for `Series.update`. Files can't be
+        buffered.
+        """
+        if _is_file(value):
+            raise TypeError("Can't buffer a file; use Series.update() instead")
+        try:
+            rows = list(value)
+        except TypeError:
+            rows = [(time.time(), value)]
+        self.batch.add(self.id, 'rows', rows, len(rows))
+
+    def increment(self, amount):
+        """
+        Queue an increment (or a decrement, if negative).
+        """
+        self.batch.add(self.id, 'increment', amount)
+
+    def __iadd__(self, amount):
+        self.increment(amount)
+        return self
+
+    def __isub__(self, amount):
+        self.increment(-amount)
+        return self
+
+class SeriesData(object):
+    """
+    Series points held compactly: timestamps and values in two `array('d')`s
+    and a bitmask of which values are null (their slot in `values` holds
+    NaN). Booleans are held as 1.0 and 0.0.
+
+    Behaves like a list of `(timestamp, value)` pairs: it has a length, can
+    be iterated over, indexed and sliced, and `between()` finds the points
+    in a time range. `buffers()` exposes the raw arrays without copying.
+    """
+    def __init__(self, points=()):
+        self.timestamps = array.array('d')
+        self.values = array.array('d')
+        self.nulls = bytearray()
+        self.null_count = 0
+        for (timestamp, value) in points:
+            self.append(timestamp, value)
+
+    def __repr__(self):
+        return "<timetric.SeriesData: %s points>" % len(self)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        if not self.null_count:
+            return itertools.izip(self.timestamps, self.values)
+        return (self[i] for i in xrange(len(self)))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(index)
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError("SeriesData index out of range")
+        if self.is_null(index):
+            return (self.timestamps[index], None)
+        return (self.timestamps[index], self.values[index])
+
+    def is_null(self, index):
+        """
+        Is the value at `index` null?
+        """
+        return bool(self.null_count and self.nulls[index >> 3] & (1 << (index & 7)))
+
+    def append(self, timestamp, value):
+        index = len(self.timestamps)
+        self.timestamps.append(timestamp)
+        if not index & 7:
+            self.nulls.append(0)
+        if value is None:
+            self.values.append(_NAN)
+            self._set_null(index)
+        else:
+            self.values.append(value)
+
+    def extend_csv(self, block):
+        """
+        Append the points in a block of Timetric CSV.
+        """
+        add_timestamp = self.timestamps.append
+        add_value = self.values.append
+        nulls = []
+        for (ts, val) in csv.reader(block.splitlines()):
+            add_timestamp(float(ts))
+            try:
+                add_value(float(val))
+            except ValueError:
+                val = _valueish(val)
+                if val is None:
+                    nulls.append(len(self.values))
+                    add_value(_NAN)
+                else:
+                    add_value(float(val))
+        self.nulls.extend(bytearray((len(self.timestamps) + 7) // 8 - len(self.nulls)))
+        for index in nulls:
+            self._set_null(index)
+
+    def between(self, start=None, end=None):
+        """
+        Get the points with `start <= timestamp < end` (either bound may be
+        None), assuming the points are in time order.
+        """
+        lo = 0
+        hi = len(self)
+        if start is not None:
+            lo = bisect.bisect_left(self.timestamps, start)
+        if end is not None:
+            hi = bisect.bisect_left(self.timestamps, end, lo)
+        return self[lo:hi]
+
+    def buffers(self):
+        """
+        Get `(timestamps, values, nulls)` as `buffer`s onto the underlying
+        arrays (native float64s and a little-endian bitmask), without
+        copying -- for `numpy.frombuffer`, say.
+        """
+        return buffer(self.timestamps), buffer(self.values), buffer(self.nulls)
+
+    def _set_null(self, index):
+        self.nulls[index >> 3] |= 1 << (index & 7)
+        self.null_count += 1
+
+    def _slice(self, index):
+        data = SeriesData()
+        data.timestamps = self.timestamps[index]
+        data.values = self.values[index]
+        start, stop, step = index.indices(len(self))
+        if step == 1 and not start & 7 and stop > start:
+            # Byte-aligned, so the mask can be copied rather than rebuilt.
+            size = stop - start
+            data.nulls = self.nulls[start >> 3:(stop + 7) >> 3]
+            if size & 7:
+                data.nulls[-1] &= (1 << (size & 7)) - 1
+            if self.null_count:
+                data.null_count = sum(len(_BITS[byte]) for byte in data.nulls)
+            return data
+        data.nulls = bytearray((len(data.timestamps) + 7) // 8)
+        if self.null_count:
+            for (new, old) in enumerate(xrange(*index.indices(len(self)))):
+                if self.is_null(old):
+                    data._set_null(new)
+        return data
+
+class SeriesMirror(object):
+    """
+    A local copy of series data, kept in `directory`.
+
+    Each series is an append-only file of little-endian float64
+    `(timestamp, value)` pairs (nulls are NaN, booleans 1.0 and 0.0), read
+    back through `mmap`. `sync()` only downloads the CSV if it's changed
+    since the last sync, and only appends points newer than the last one
+    held; if the series has been rewritten or backfilled, the copy is
+    rebuilt. If the client's `server_ranges` is set only the points from
+    the last one held on are downloaded, which means only a change to that
+    point is noticed; `delete()` the copy to pick up older ones.
+
+    A mirror directory shouldn't be synced by more than one process at once.
+    """
+    record_size = 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, id):
+        return os.path.join(self.directory, urllib.quote(id, safe=''))
+
+    def __contains__(self, id):
+        return os.path.exists(self.path(id))
+
+    def count(self, id):
+        """
+        The number of points held for a series.
+        """
+        try:
+            return os.path.getsize(self.path(id)) // self.record_size
+        except OSError:
+            return 0
+
+    def last(self, id):
+        """
+        The last `(timestamp, value)` pair held for a series, or None.
+        """
+        count = self.count(id)
+        if not count:
+            return None
+        f = open(self.path(id), 'rb')
+        try:
+            f.seek((count - 1) * self.record_size)
+            return _unpack_points(f.read(self.record_size))[0]
+        finally:
+            f.close()
+
+    def arrays(self, id):
+        """
+        Get a series' points as a pair of `array('d')`s, `(timestamps,
+        values)`, with NaN for nulls.
+        """
+        flat = array.array('d')
+        for block in self._blocks(id):
+            flat.fromstring(block)
+        if sys.byteorder == 'big':
+            flat.byteswap()
+        return flat[0::2], flat[1::2]
+
+    def data(self, id):
+        """
+        Get a series' points as a `SeriesData`.
+        """
+        data = SeriesData()
+        data.timestamps, data.values = self.arrays(id)
+        data.nulls = bytearray((len(data.timestamps) + 7) // 8)
+        for (index, value) in enumerate(data.values):
+            if value != value:
+                data._set_null(index)
+        return data
+
+    def points(self, id):
+        """
+        Iterate over a series' `(timestamp, value)` pairs.
+        """
+        for block in self._blocks(id):
+            for point in _unpack_points(block):
+                yield point
+
+    def _blocks(self, id, block_size=CHUNK_SIZE):
+        count = self.count(id)
+        if not count:
+            return
+        f = open(self.path(id), 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), count * self.record_size,
+                          access=mmap.ACCESS_READ)
+            try:
+                for start in xrange(0, len(m), block_size):
+                    yield m[start:start + block_size]
+            finally:
+                m.close()
+        finally:
+            f.close()
+
+    def sync(self, series):
+        """
+        Bring the copy of a `Series` up to date. Returns the number of points
+        added (or, if the copy was rebuilt, the number now held).
+        """
+        path = self.path(series.id)
+        count = self.count(series.id)
+        self._truncate(path, count)
+        last = self.last(series.id)
+        if last is not None:
+            last = last[0]
+        meta = self._meta(series.id)
+        headers = {}
+        if count and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        params = None
+        if last is not None and series.client.server_ranges:
+            # The range is inclusive, so the last point held comes back too.
+            params = {'start': last}
+        with series._csv_stream(params, headers) as resp:
+            if resp.status == 304:
+                return 0
+            etag = resp.getheader('etag')
+            rows = csv.reader(_iter_lines(resp, CHUNK_SIZE))
+            f = open(path, 'ab')
+            try:
+                seen, added = self._append(f, rows, last)
+            finally:
+                f.close()
+        if seen != count and not (params and seen):
+            # Old points have changed under us; start again from scratch.
+            self.delete(series.id)
+            return self.sync(series)
+        self._save_meta(series.id, {'etag': etag})
+        return added
+
+    def delete(self, id):
+        """
+        Forget everything held for a series.
+        """
+        for path in (self.path(id), self.path(id) + '.meta'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _append(self, f, rows, after):
+        """
+        Write the rows newer than `after` to `f`. Returns `(number of rows not
+        newer, number written)`.
+        """
+        seen = added = 0
+        buf = array.array('d')
+        for (ts, val) in rows:
+            ts = float(ts)
+            if after is not None and ts <= after:
+                seen += 1
+                continue
+            val = _valueish(val)
+            buf.append(ts)
+            buf.append(val is None and _NAN or float(val))
+            added += 1
+            if len(buf) >= CHUNK_SIZE // 8:
+                _write_points(f, buf)
+                buf = array.array('d')
+        _write_points(f, buf)
+        return seen, added
+
+    def _truncate(self, path, count):
+        # Drop any partial record left by an interrupted sync.
+        if os.path.exists(path) and os.path.getsize(path) != count * self.record_size:
+            f = open(path, 'r+b')
+            try:
+                f.truncate(count * self.record_size)
+            finally:
+                f.close()
+
+    def _meta(self, id):
+        try:
+            f = open(self.path(id) + '.meta')
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _save_meta(self, id, meta):
+        f = open(self.path(id) + '.meta', 'w')
+        try:
+            json.dump(meta, f)
+        finally:
+            f.close()
+
+class SeriesSnapshot(object):
+    """
+    A copy of a series' data in a compact columnar file at `path`, as
+    written by `Series.dump()` or `from_csv()`.
+
+    The file is a header followed by blocks of up to `block_size` points.
+    Each block holds the block's little-endian float64 timestamps, then its
+    values, then a bitmask of which values are null (as in `SeriesData`), and
+    may be zlib-compressed; compressed blocks are byte-shuffled first, which
+    lets zlib find the runs in slowly changing floats. Booleans are held as
+    1.0 and 0.0.
+
+    Snapshots are read and written a block at a time, so neither depends on
+    the size of the series for its memory use.
+    """
+    magic = 'TTSERIES'
+    version = 1
+    block_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return "<timetric.SeriesSnapshot: %r>" % self.path
+
+    def __len__(self):
+        f = open(self.path, 'rb')
+        try:
+            return self._read_header(f)[1]
+        finally:
+            f.close()
+
+    def __iter__(self):
+        for block in self.blocks():
+            for point in block:
+                yield point
+
+    @classmethod
+    def from_csv(cls, path, file, compress=None, chunk_size=CHUNK_SIZE, block_size=None):
+        """
+        Write a snapshot of the Timetric CSV in the file-like object `file` to
+        `path`, zlib-compressed at level `compress` if it's given, in blocks
+        of `block_size` points (the class's `block_size` by default).
+        """
+        f = open(path, 'wb')
+        try:
+            writer = _SnapshotWriter(f, compress, block_size or cls.block_size)
+            for block in _iter_blocks(file, chunk_size):
+                writer.extend_csv(block)
+            writer.close()
+        finally:
+            f.close()
+        return cls(path)
+
+    def to_csv(self, file=None):
+        """
+        Write the snapshot out as Timetric CSV to the file-like object `file`.
+        If it's None a temporary file is used, kept in memory up to
+        `SPOOL_SIZE` bytes; either way the file is returned, rewound if it
+        can be.
+        """
+        if file is None:
+            file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        for block in self.blocks():
+            rows = zip(block.timestamps.tolist(), block.values.tolist())
+            text = ''.join(map('%r,%r\n'.__mod__, rows))
+            if block.null_count:
+                text = text.replace(',nan\n', ',null\n')
+            file.write(text)
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        return file
+
+    def data(self):
+        """
+        Read the whole snapshot into a `SeriesData`.
+        """
+        data = SeriesData()
+        for block in self.blocks():
+            start = len(data)
+            data.timestamps.extend(block.timestamps)
+            data.values.extend(block.values)
+            data.nulls.extend(bytearray((len(data.timestamps) + 7) // 8 - len(data.nulls)))
+            for (offset, byte) in enumerate(block.nulls):
+                for bit in _BITS[byte]:
+                    data._set_null(start + offset * 8 + bit)
+        return data
+
+    def blocks(self):
+        """
+        Iterate over the snapshot's blocks as `SeriesData`s.
+        """
+        f = open(self.path, 'rb')
+        try:
+            flags, count = self._read_header(f)
+            seen = 0
+            while True:
+                head = f.read(_SNAPSHOT_BLOCK.size)
+                if len(head) < _SNAPSHOT_BLOCK.size:
+                    raise ValueError("Truncated snapshot: %s" % self.path)
+                points, size, crc = _SNAPSHOT_BLOCK.unpack(head)
+                if not points:
+                    break
+                payload = f.read(size)
+                if len(payload) < size or zlib.crc32(payload) & 0xffffffff != crc:
+                    raise ValueError("Corrupt snapshot: %s" % self.path)
+                seen += points
+                yield _decode_snapshot_block(payload, points, flags)
+            if seen != count:
+                raise ValueError("Corrupt snapshot: %s" % self.path)
+        finally:
+            f.close()
+
+    def _read_header(self, f):
+        head = f.read(_SNAPSHOT_HEADER.size)
+        if len(head) < _SNAPSHOT_HEADER.size or not head.startswith(self.magic):
+            raise ValueError("Not a series snapshot: %s" % self.path)
+        magic, version, flags, count = _SNAPSHOT_HEADER.unpack(head)
+        if version != self.version:
+            raise ValueError("Unsupported snapshot version %s: %s" % (version, self.path))
+        return flags, count
+
+class _SnapshotWriter(object):
+    """
+    Writes a `SeriesSnapshot` to the seekable file `f`, a block at a time.
+    """
+    def __init__(self, f, compress=None, block_size=SeriesSnapshot.block_size):
+        self.f = f
+        self.compress = compress
+        self.block_size = block_size
+        self.flags = compress and _SNAPSHOT_ZLIB | _SNAPSHOT_SHUFFLE or 0
+        self.count = 0
+        self.pending = SeriesData()
+        self.start = f.tell()
+        f.write(self._header())
+
+    def extend_csv(self, block):
+        self.pending.extend_csv(block)
+        while len(self.pending) >= self.block_size:
+            data = self.pending
+            self.pending = data[self.block_size:]
+            self._write_data(data[:self.block_size])
+
+    def flush(self):
+        data = self.pending
+        if not data:
+            return
+        self.pending = SeriesData()
+        self._write_data(data)
+
+    def _write_data(self, data):
+        self._write_block(len(data), _encode_snapshot_block(data, self.compress))
+        self.count += len(data)
+
+    def close(self):
+        self.flush()
+        self._write_block(0, '')
+        end = self.f.tell()
+        self.f.seek(self.start)
+        self.f.write(self._header())
+        self.f.seek(end)
+
+    def _header(self):
+        return _SNAPSHOT_HEADER.pack(SeriesSnapshot.magic, SeriesSnapshot.version,
+                                     self.flags, self.count)
+
+    def _write_block(self, points, payload):
+        self.f.write(_SNAPSHOT_BLOCK.pack(points, len(payload),
+                                          zlib.crc32(payload) & 0xffffffff))
+        self.f.write(payload)
+
+_SNAPSHOT_HEADER = struct.Struct('<8sBB2xQ')
+_SNAPSHOT_BLOCK = struct.Struct('<III')
+_SNAPSHOT_ZLIB = 1
+_SNAPSHOT_SHUFFLE = 2
+
+def _encode_snapshot_block(data, compress):
+    columns = [data.timestamps, data.values]
+    if sys.byteorder == 'big':
+        columns = [array.array('d', column) for column in columns]
+        for column in columns:
+            column.byteswap()
+    columns = [column.tostring() for column in columns]
+    if not compress:
+        return ''.join(columns) + str(data.nulls)
+    columns = [''.join([column[i::8] for i in xrange(8)]) for column in columns]
+    return zlib.compress(''.join(columns) + str(data.nulls), compress)
+
+def _decode_snapshot_block(payload, points, flags):
+    if flags & _SNAPSHOT_ZLIB:
+        payload = zlib.decompress(payload)
+    size = points * 8
+    if len(payload) != size * 2 + (points + 7) // 8:
+        raise ValueError("Corrupt snapshot block")
+    data = SeriesData()
+    for (column, start) in ((data.timestamps, 0), (data.values, size)):
+        if flags & _SNAPSHOT_SHUFFLE:
+            unshuffled = bytearray(size)
+            for i in xrange(8):
+                unshuffled[i::8] = payload[start + i * points:start + (i + 1) * points]
+            column.fromstring(str(unshuffled))
+        else:
+            column.fromstring(payload[start:start + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+    data.nulls = bytearray(payload[size * 2:])
+    if data.nulls.count('\0') != len(data.nulls):
+        data.null_count = sum(len(_BITS[byte]) for byte in data.nulls)
+    return data
+
+# The set bits in each byte value.
+_BITS = [tuple(bit for bit in xrange(8) if byte & (1 << bit)) for byte in xrange(256)]
+
+_NAN = float('nan')
+
+def _write_points(f, points):
+    if sys.byteorder == 'big':
+        points = array.array('d', points)
+        points.byteswap()
+    f.write(points.tostring())
+
+def _unpack_points(data):
+    """
+    Unpack little-endian float64 pairs into `(timestamp, value)` tuples, with
+    None for NaN values.
+    """
+    flat = array.array('d')
+    flat.fromstring(data)
+    if sys.byteorder == 'big':
+        flat.byteswap()
+    points = []
+    for (ts, val) in zip(flat[0::2], flat[1::2]):
+        if val != val:
+            val = None
+        points.append((ts, val))
+    return points
+
+class RequestEvent(object):
+    """
+    What happened during one request, as passed to a client's observers.
+
+    Has the request's `method` and `url`, the `series_id` it was about (if
+    any) and an `endpoint` naming the kind of request, such as ``GET
+    /series/<id>/csv/``. Then the outcome: the response `status` or the
+    `error` raised, `bytes_sent` and `bytes_received` (None for streamed
+    responses), and the seconds spent building the body (`encode_time`),
+    waiting on the client's rate limiter (`queue_time`), signing
+    (`sign_time`) and on the network (`network_time`, up to the response
+    headers for streamed responses).
+    """
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        self.series_id, self.endpoint = _endpoint(method, url)
+        self.status = None
+        self.error = None
+        self.bytes_sent = 0
+        self.bytes_received = None
+        self.encode_time = self.queue_time = self.sign_time = self.network_time = 0.0
+
+    def __repr__(self):
+        return "<timetric.RequestEvent: %s %s>" % (self.endpoint, self.status)
+
+    @property
+    def total_time(self):
+        return self.encode_time + self.queue_time + self.sign_time + self.network_time
+
+_SERIES_PATH = re.compile(r'/series/([^/]+)/(.*)$')
+
+def _endpoint(method, url):
+    """
+    Work out `(series id, endpoint name)` for a request.
+    """
+    path = urlparse.urlsplit(url)[2]
+    match = _SERIES_PATH.search(path)
+    if match:
+        return match.group(1), "%s /series/<id>/%s" % (method, match.group(2))
+    return None, "%s %s" % (method, path)
+
+class RequestStats(object):
+    """
+    A client observer that keeps running totals per endpoint.
+
+    `summary()` returns a dict of endpoint names to dicts of: `count`,
+    `errors` (requests that raised), `statuses` (a count per status), total
+    `bytes_sent` and `bytes_received`, total `encode_time`, `queue_time`,
+    `sign_time`, `network_time` and `total_time`, and a `histogram` of total times: the
+    number of requests taking up to each of `buckets` seconds, with one last
+    count for anything slower.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            stats = self.endpoints.get(event.endpoint)
+            if stats is None:
+                stats = self.endpoints[event.endpoint] = {
+                    'count': 0, 'errors': 0, 'statuses': {},
+                    'bytes_sent': 0, 'bytes_received': 0,
+                    'encode_time': 0.0, 'queue_time': 0.0, 'sign_time': 0.0,
+                    'network_time': 0.0, 'total_time': 0.0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                }
+            stats['count'] += 1
+            if event.error is not None:
+                stats['errors'] += 1
+            else:
+                stats['statuses'][event.status] = stats['statuses'].get(event.status, 0) + 1
+            stats['bytes_sent'] += event.bytes_sent
+            stats['bytes_received'] += event.bytes_received or 0
+            stats['encode_time'] += event.encode_time
+            stats['queue_time'] += event.queue_time
+            stats['sign_time'] += event.sign_time
+            stats['network_time'] += event.network_time
+            stats['total_time'] += event.total_time
+            stats['histogram'][bisect.bisect_left(self.buckets, event.total_time)] += 1
+
+    def summary(self):
+        with self.lock:
+            return copy.deepcopy(self.endpoints)
+
+class RetryPolicy(object):
+    """
+    How a `TimetricClient` retries failed requests.
+
+    A request that raises a network error, or gets one of `retry_statuses`
+    back, is retried up to `retries` times if its method is one of
+    `retry_methods` (POSTs, such as increments, aren't safe to repeat, so
+    aren't retried unless they're added). Retries back off exponentially
+    from `backoff` seconds up to `max_backoff`, with jitter.
+
+    The policy also keeps a `CircuitBreaker` per host: after
+    `failure_threshold` failures in a row requests to that host fail
+    straight away, with `CircuitOpenError`, for `reset_timeout` seconds.
+    """
+    @property
+    def errors(self):
+        return (EnvironmentError, httplib.HTTPException, httplib2.HttpLib2Error)
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=10.0,
+                 retry_statuses=(500, 502, 503, 504),
+                 retry_methods=('GET', 'HEAD', 'PUT', 'DELETE'),
+                 failure_threshold=5, reset_timeout=30.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.retry_methods = retry_methods
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def should_retry(self, method, attempt):
+        return method in self.retry_methods and attempt < self.retries
+
+    def delay(self, attempt):
+        """
+        How long to wait before retry number `attempt` (counting from 0).
+        """
+        delay = float(min(self.max_backoff, self.backoff * 2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class CircuitOpenError(TimetricClientError):
+    pass
+
+class CircuitBreaker(object):
+    """
+    Tracks failures per host, and stops requests to a host for
+    `reset_timeout` seconds once it's failed `failure_threshold` times in a
+    row. After that one request is let through to try the water: if it
+    succeeds the host is back in service, and if not it's shut off again.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def before(self, host):
+        """
+        Raise `CircuitOpenError` if requests to `host` are shut off.
+        """
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return
+            if time.time() - opened < self.reset_timeout:
+                raise CircuitOpenError("Too many failures from %s; not trying "
+                                       "again for a while" % host)
+            # Let this request through as a trial; others carry on failing
+            # fast until it's done.
+            self.opened[host] = time.time()
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failure_threshold and self.failures[host] >= self.failure_threshold:
+                self.opened[host] = time.time()
+
+class RateLimiter(object):
+    """
+    Paces a `TimetricClient`'s requests: at most `requests_per_s` requests
+    and `bytes_per_s` bytes (sent, and received once a response has been
+    read) a second, and at most `series_requests_per_s` requests a second
+    to any one series. Each limit is a token bucket holding `burst` seconds'
+    worth, so short bursts go straight through; None means no limit.
+
+    A throttling response (one of `throttle_statuses`) slows everything
+    down. A Retry-After header stops all requests for that long (up to
+    `max_pause` seconds), and the rates are halved, at most once a second,
+    down to `min_scale` of what they were set to; each successful response
+    then builds them back up by `recovery`. With no rates set, a throttling
+    response without a Retry-After pauses requests for `pause` seconds.
+
+    When reads (GETs and HEADs) and writes are both waiting they take
+    turns, so neither a bulk upload nor a crawl can starve the other.
+    `stats()` reports the effective rates and how long requests waited.
+    """
+    def __init__(self, requests_per_s=None, bytes_per_s=None,
+                 series_requests_per_s=None, burst=1.0,
+                 throttle_statuses=(429, 503), min_scale=0.05, recovery=0.05,
+                 pause=1.0, max_pause=300.0, max_series=10000):
+        self.requests_per_s = requests_per_s
+        self.bytes_per_s = bytes_per_s
+        self.series_requests_per_s = series_requests_per_s
+        self.burst = burst
+        self.throttle_statuses = throttle_statuses
+        self.min_scale = min_scale
+        self.recovery = recovery
+        self.pause = pause
+        self.max_pause = max_pause
+        self.scale = 1.0
+        self.paused_until = self.last_cut = 0.0
+        self.request_tokens = _TokenBucket(requests_per_s, burst)
+        self.byte_tokens = _TokenBucket(bytes_per_s, burst)
+        self.series_tokens = _LRUCache(max_series)
+        self.waiting = {'read': deque(), 'write': deque()}
+        self.turn = 'read'
+        self.counts = {'read': 0, 'write': 0}
+        self.queue_time = {'read': 0.0, 'write': 0.0}
+        self.max_queue_time = 0.0
+        self.throttled = 0
+        self.recent = deque(maxlen=100)
+        self.lock = threading.Condition()
+
+    def acquire(self, method, url, size=0):
+        """
+        Wait until a request of `size` bytes may be sent, and return how
+        many seconds that took.
+        """
+        start = time.time()
+        if self.series_requests_per_s:
+            id = _endpoint(method, url)[0]
+            if id is not None:
+                self._wait_for_series(id)
+        kind = method in ('GET', 'HEAD') and 'read' or 'write'
+        other = kind == 'read' and 'write' or 'read'
+        queue = self.waiting[kind]
+        ticket = object()
+        with self.lock:
+            queue.append(ticket)
+            try:
+                while True:
+                    delay = self._delay(queue, ticket, other, size)
+                    if not delay:
+                        break
+                    if delay is _TURN:
+                        self.lock.wait()
+                    else:
+                        # Condition.wait's timeouts are coarse; sleep instead,
+                        # as nobody else can go ahead of us anyway.
+                        self.lock.release()
+                        try:
+                            time.sleep(delay)
+                        finally:
+                            self.lock.acquire()
+            except:
+                queue.remove(ticket)
+                self.lock.notify_all()
+                raise
+            queue.popleft()
+            now = time.time()
+            self.request_tokens.take(1, self.scale, now)
+            self.byte_tokens.take(size, self.scale, now)
+            self.turn = other
+            waited = now - start
+            self.counts[kind] += 1
+            self.queue_time[kind] += waited
+            self.max_queue_time = max(self.max_queue_time, waited)
+            self.recent.append(now)
+            self.lock.notify_all()
+        return waited
+
+    def feedback(self, status, retry_after=None, received=0):
+        """
+        Take note of a response: its `status`, Retry-After header (if any)
+        and the number of body bytes `received`.
+        """
+        with self.lock:
+            now = time.time()
+            self.byte_tokens.take(received, self.scale, now)
+            if status not in self.throttle_statuses:
+                if status < 400 and self.scale < 1.0:
+                    self.scale = min(1.0, self.scale + self.recovery)
+                return
+            self.throttled += 1
+            pause = _retry_after(retry_after, now)
+            if pause is None and not (self.requests_per_s or self.bytes_per_s):
+                pause = self.pause
+            if pause is not None:
+                self.paused_until = max(self.paused_until, now + min(pause, self.max_pause))
+            if now - self.last_cut >= 1.0:
+                self.scale = max(self.min_scale, self.scale / 2)
+                self.last_cut = now
+
+    def stats(self):
+        """
+        Return a dict of: the effective `requests_per_s`, `bytes_per_s` and
+        `series_requests_per_s` (the limits scaled down after throttling,
+        None for no limit) and the `scale` itself; the `observed_rate` of
+        the last 100 requests; counts of `reads`, `writes` and `throttled`
+        responses; the number of requests `queued` now; the `paused` seconds
+        left of a Retry-After; and the mean and max seconds requests spent
+        queued (`mean_queue_time`, `max_queue_time`, and `read_queue_time`
+        and `write_queue_time` for each kind).
+        """
+        with self.lock:
+            def scaled(rate):
+                return rate and rate * self.scale
+            requests = self.counts['read'] + self.counts['write']
+            recent = self.recent
+            return {
+                'requests_per_s': scaled(self.requests_per_s),
+                'bytes_per_s': scaled(self.bytes_per_s),
+                'series_requests_per_s': scaled(self.series_requests_per_s),
+                'scale': self.scale,
+                'observed_rate': len(recent) > 1 and
+                                 (len(recent) - 1) / ((recent[-1] - recent[0]) or 1e-6) or 0.0,
+                'reads': self.counts['read'],
+                'writes': self.counts['write'],
+                'throttled': self.throttled,
+                'queued': len(self.waiting['read']) + len(self.waiting['write']),
+                'paused': max(0.0, self.paused_until - time.time()),
+                'mean_queue_time': sum(self.queue_time.values()) / (requests or 1),
+                'max_queue_time': self.max_queue_time,
+                'read_queue_time': self.queue_time['read'] / (self.counts['read'] or 1),
+                'write_queue_time': self.queue_time['write'] / (self.counts['write'] or 1),
+            }
+
+    def _delay(self, queue, ticket, other, size):
+        """
+        How long the request holding `ticket` has to wait: 0 if it can go
+        now, a number of seconds, or `_TURN` if it has to wait for others to
+        go first.
+        """
+        if queue[0] is not ticket:
+            return _TURN
+        if self.waiting[other] and self.turn == other:
+            return _TURN
+        now = time.time()
+        return max(self.paused_until - now,
+                   self.request_tokens.wait(1, self.scale, now),
+                   self.byte_tokens.wait(size, self.scale, now), 0)
+
+    def _wait_for_series(self, id):
+        with self.lock:
+            bucket = self.series_tokens.get(id)
+            if bucket is None:
+                bucket = self.series_tokens[id] = _TokenBucket(
+                    self.series_requests_per_s, self.burst)
+            now = time.time()
+            delay = bucket.wait(1, self.scale, now)
+            # Book the slot now, so later requests for the series queue up
+            # behind this one.
+            bucket.take(1, self.scale, now)
+        if delay:
+            time.sleep(delay)
+
+# Returned by `RateLimiter._delay` when a request must wait its turn.
+_TURN = object()
+
+class _TokenBucket(object):
+    """
+    Tokens that fill up at `rate` a second, times the `scale` given to each
+    call, to hold at most `burst` seconds' worth. A rate of None never runs
+    out.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = rate and max(1.0, rate * burst)
+        self.updated = time.time()
+
+    def wait(self, amount, scale, now):
+        """
+        How many seconds until `amount` tokens can be taken. Anything bigger
+        than the bucket only has to wait for a full one.
+        """
+        if not self.rate:
+            return 0.0
+        self._fill(scale, now)
+        needed = min(amount, self._capacity(scale)) - self.tokens
+        return max(0.0, needed / (self.rate * scale))
+
+    def take(self, amount, scale, now):
+        """
+        Take `amount` tokens, going into debt if there aren't enough.
+        """
+        if self.rate:
+            self._fill(scale, now)
+            self.tokens -= amount
+
+    def _capacity(self, scale):
+        return max(1.0, self.rate * scale * self.burst)
+
+    def _fill(self, scale, now):
+        self.tokens = min(self._capacity(scale),
+                          self.tokens + (now - self.updated) * self.rate * scale)
+        self.updated = now
+
+def _retry_after(value, now):
+    """
+    Parse a Retry-After header (seconds, or an HTTP date) into the number of
+    seconds to wait, or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - now)
+
+class HttpPool(object):
+    """
+    A thread-safe stand-in for `httplib2.Http`.
+
+    Each request borrows an `httplib2.Http` (and so its keep-alive
+    connection) for the request's host, creating one if fewer than `size`
+    exist for that host and waiting for one to be returned otherwise.
+    Connections left idle for longer than `idle_timeout` seconds are closed.
+
+    `stats` counts `hits` (an idle connection was reused), `misses` (a new
+    one was made), `waits` (the pool was full) and `expired` connections.
+
+    Only requests whose responses are read in full go through the pool.
+    A client's streamed reads hold a connection for as long as the caller
+    takes over the body, and a pool slot held that long could leave a
+    request made mid-stream waiting for it for ever. So they each use
+    a connection of their own, outside the pool and its `size`.
+    """
+    def __init__(self, size=10, idle_timeout=60):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.follow_redirects = True
+        self.lock = threading.Condition()
+        self.idle = {}
+        self.open = {}
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'expired': 0}
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        host = urlparse.urlsplit(uri)[:2]
+        http = self._acquire(host)
+        try:
+            result = http.request(uri, method, body=body, headers=headers, **kwargs)
+        except:
+            # Who knows what state the connection is in; don't reuse it.
+            self._discard(host, http)
+            raise
+        self._release(host, http)
+        return result
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            for (host, idle) in self.idle.items():
+                for (last_used, http) in idle:
+                    _close_http(http)
+                self.open[host] -= len(idle)
+            self.idle.clear()
+
+    def _acquire(self, host):
+        with self.lock:
+            waited = False
+            while True:
+                idle = self.idle.setdefault(host, [])
+                cutoff = time.time() - self.idle_timeout
+                while idle and idle[0][0] < cutoff:
+                    _close_http(idle.pop(0)[1])
+                    self.open[host] -= 1
+                    self.stats['expired'] += 1
+                if idle:
+                    self.stats['hits'] += 1
+                    return idle.pop()[1]
+                if self.open.get(host, 0) < self.size:
+                    self.open[host] = self.open.get(host, 0) + 1
+                    self.stats['misses'] += 1
+                    break
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                self.lock.wait()
+        http = _new_http()
+        http.follow_redirects = self.follow_redirects
+        return http
+
+    def _release(self, host, http):
+        with self.lock:
+            self.idle[host].append((time.time(), http))
+            self.lock.notify()
+
+    def _discard(self, host, http):
+        _close_http(http)
+        with self.lock:
+            self.open[host] -= 1
+            self.lock.notify()
+
+_Http = None
+
+class _StreamingSendMixin:
+    """
+    Makes an httplib connection send a `BodyStream` body with `send_to()`,
+    rather than reading it. (httplib's are classic classes, so this is one
+    too, and calls `send` on httplib's base class directly.)
+    """
+    def send(self, data):
+        if not isinstance(data, BodyStream):
+            return httplib.HTTPConnection.send(self, data)
+        if self.sock is None:
+            self.connect()
+        data.send_to(self.sock)
+
+def _new_http():
+    """
+    Make an `httplib2.Http` whose connections send `BodyStream` bodies with
+    `send_to()`, rather than reading them.
+
+    The classes involved subclass httplib2's, so they're only defined once
+    httplib2 has been imported.
+    """
+    global _Http
+    if _Http is None:
+        class _HTTPConnection(_StreamingSendMixin, httplib2.HTTPConnectionWithTimeout):
+            pass
+
+        class _HTTPSConnection(_StreamingSendMixin, httplib2.HTTPSConnectionWithTimeout):
+            pass
+
+        class _Http(httplib2.Http):
+            connection_types = {'http': _HTTPConnection, 'https': _HTTPSConnection}
+
+            def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+                if 'connection_type' not in kwargs:
+                    scheme = urlparse.urlsplit(uri)[0].lower()
+                    kwargs['connection_type'] = self.connection_types.get(scheme)
+                return httplib2.Http.request(self, uri, method, body, headers, **kwargs)
+
+    return _Http()
+
+def _close_http(http):
+    for conn in http.connections.values():
+        conn.close()
+
+class MemoryCache(object):
+    """
+    An in-memory, thread-safe LRU response cache for `TimetricClient`,
+    holding at most `max_bytes` of response bodies.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = _LRUCache(sys.maxint)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self._delete(key)
+            size = len(value[1])
+            if size > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, old_value = self.entries.popitem()
+                self.size -= len(old_value[1])
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        value = self.entries.pop(key)
+        if value is not None:
+            self.size -= len(value[1])
+
+class DiskCache(object):
+    """
+    An on-disk response cache for `TimetricClient`: one file per URL in
+    `directory`, which is created if need be.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest())
+
+    def get(self, key):
+        try:
+            f = open(self.path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            headers = json.loads(f.readline())
+            return headers, f.read()
+        finally:
+            f.close()
+
+    def set(self, key, value):
+        headers, body = value
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(json.dumps(headers) + '\n')
+            f.write(body)
+        finally:
+            f.close()
+        os.rename(tmp, self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+class Future(object):
+    """
+    The eventual result of a call running on another thread.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result, re-raising any
+        exception it raised.
+        """
+        if not self._done.wait(timeout):
+            raise TimetricClientError("Timed out waiting for result")
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call to finish and return the exception it raised, or
+        None if it succeeded.
+        """
+        if not self._done.wait(timeout):
+            raise TimetricClientError("Timed out waiting for result")
+        return self._exc_info and self._exc_info[1] or None
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(future)` once the call has finished (straight away if
+        it already has).
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+class _Executor(object):
+    """
+    A fixed-size pool of daemon threads running calls off a queue.
+    """
+    def __init__(self, max_workers):
+        if max_workers < 1:
+            raise ValueError("Need at least one worker")
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in xrange(max_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func):
+        future = Future()
+        self.queue.put((future, func))
+        return future
+
+    def shutdown(self, wait=True):
+        for thread in self.threads:
+            self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, func = item
+            try:
+                result = func()
+            except Exception:
+                future._set(exc_info=sys.exc_info())
+            else:
+                future._set(result)
+
+def _iterable_to_stream(values):
+    """
+    Convert an iterable of 2-tuples into a file-like object for the dataset.
+
+    The CSV is written to a spooled temporary file, so only the first
+    `SPOOL_SIZE` bytes are held in memory however many rows there are.
+    """
+    io = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    writer = csv.writer(io)
+    parse_timestamp = _TimestampParser()
+    for timestamp, value in values:
+        writer.writerow([parse_timestamp(timestamp), value])
+    io.seek(0)
+    return io
+    
+def _arrays_to_stream(timestamps, values, rows_per_block=100000):
+    """
+    Convert float64 timestamp and value arrays into a file-like CSV object.
+    """
+    io = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for start in xrange(0, len(timestamps), rows_per_block):
+        end = start + rows_per_block
+        rows = zip(timestamps[start:end].tolist(), values[start:end].tolist())
+        io.write(''.join(map('%r,%r\n'.__mod__, rows)).replace(',nan\n', ',null\n'))
+    io.seek(0)
+    return io
+
+def _parse_timestamp(timestamp):
+    """
+    Parse a timestamp into a format that Timetric understands.
+    """
+    if hasattr(timestamp, 'timetuple'):
+        return _datetime_to_epoch(timestamp)
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return _datetime_to_epoch(dateutil.parser.parse(timestamp))
+
+def _datetime_to_epoch(dt):
+    """
+    Convert a datetime (or date) to Unix time. Naive datetimes are taken to
+    be in local time, daylight saving and all; aware ones are converted
+    from their own offset.
+    """
+    if getattr(dt, 'tzinfo', None) is not None and dt.utcoffset() is not None:
+        result = calendar.timegm(dt.utctimetuple())
+    else:
+        result = time.mktime(dt.timetuple())
+    return result + getattr(dt, 'microsecond', 0) / 1e6
+
+def _local_to_epoch(wallclock):
+    """
+    Convert a NumPy array of naive local times, as seconds from 1970-01-01
+    00:00, to Unix time the same way `_datetime_to_epoch` does. The UTC
+    offset is looked up once per quarter-hour in the array, not per point.
+    """
+    import numpy
+    buckets, inverse = numpy.unique(numpy.floor(wallclock / 900.0) * 900,
+                                    return_inverse=True)
+    offsets = numpy.array([t - time.mktime(time.gmtime(t)[:8] + (-1,))
+                           for t in buckets])
+    return wallclock - offsets[inverse]
+
+class _TimestampParser(object):
+    """
+    A faster `_parse_timestamp` for parsing a run of timestamps.
+
+    The format of the first string timestamps (epoch seconds or millis,
+    ISO-8601, RFC 2822) is detected and the rest are parsed with a dedicated
+    parser, falling back to detection again -- and then `dateutil` -- for
+    anything that doesn't fit. Results for recently seen strings are cached.
+    Results are the same as `_parse_timestamp`'s, except that 13-digit
+    strings are taken to be epoch milliseconds.
+    """
+    def __init__(self, cache_size=1024):
+        self.format = None
+        self.cache = _LRUCache(cache_size)
+
+    def __call__(self, timestamp):
+        if not isinstance(timestamp, basestring):
+            if hasattr(timestamp, 'timetuple'):
+                return _datetime_to_epoch(timestamp)
+            return float(timestamp)
+        if self.format is _parse_epoch:
+            try:
+                result = float(timestamp)
+            except ValueError:
+                pass
+            else:
+                if len(timestamp) == 13 and timestamp.isdigit():
+                    result /= 1000.0
+                return result
+        result = self.cache.get(timestamp)
+        if result is not None:
+            return result
+        if self.format is not None:
+            result = self.format(timestamp)
+        if result is None:
+            result = self._detect(timestamp)
+        self.cache[timestamp] = result
+        return result
+
+    def _detect(self, timestamp):
+        for format in _TIMESTAMP_FORMATS:
+            result = format(timestamp)
+            if result is not None:
+                self.format = format
+                return result
+        return _parse_timestamp(timestamp)
+
+def _parse_epoch(timestamp):
+    """
+    Parse Unix time in seconds, or in milliseconds if it's 13 digits long.
+    """
+    try:
+        result = float(timestamp)
+    except ValueError:
+        return None
+    if len(timestamp) == 13 and timestamp.isdigit():
+        result /= 1000.0
+    return result
+
+_ISO_8601 = re.compile(
+    r'^\s*(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)([.,]\d+)?)?)?'
+    r'\s*(?:(Z)|([+-])(\d\d):?(\d\d))?\s*$'
+)
+
+def _parse_iso8601(timestamp):
+    """
+    Parse an ISO-8601 date or date and time, with or without a UTC offset.
+    """
+    match = _ISO_8601.match(timestamp)
+    if not match:
+        return None
+    y, mo, d, h, mi, s, fraction, z, sign, tzh, tzm = match.groups()
+    try:
+        dt = datetime.datetime(int(y), int(mo), int(d),
+                               int(h or 0), int(mi or 0), int(s or 0),
+                               fraction and int(fraction[1:7].ljust(6, '0')) or 0)
+    except ValueError:
+        return None
+    if not (z or sign):
+        return _datetime_to_epoch(dt)
+    if sign:
+        offset = datetime.timedelta(hours=int(tzh), minutes=int(tzm))
+        if sign == '+':
+            dt -= offset
+        else:
+            dt += offset
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+_RFC_2822 = re.compile(
+    r'^\s*(?:[A-Za-z]{3},\s*)?\d{1,2}\s+[A-Za-z]{3}\s+\d{4}'
+    r'\s+\d\d:\d\d(?::\d\d)?(?:\s+(?:[+-]\d{4}|GMT|UTC?|Z))?\s*$'
+)
+
+def _parse_rfc2822(timestamp):
+    """
+    Parse an RFC 2822 date such as "Wed, 11 Mar 2009 01:30:00 +0000".
+    """
+    if not _RFC_2822.match(timestamp):
+        return None
+    parsed = email.utils.parsedate_tz(timestamp)
+    if parsed is None:
+        return None
+    try:
+        dt = datetime.datetime(*parsed[:6])
+    except ValueError:
+        return None
+    if parsed[9] is None:
+        return _datetime_to_epoch(dt)
+    dt -= datetime.timedelta(seconds=parsed[9])
+    return calendar.timegm(dt.timetuple())
+
+_TIMESTAMP_FORMATS = (_parse_epoch, _parse_iso8601, _parse_rfc2822)
+
+class _OAuthSigner(object):
+    """
+    Signs requests with OAuth HMAC-SHA1, making byte-for-byte the same
+    signatures as `oauth.OAuthRequest.sign_request` but doing most of the
+    work up front: the key material is encoded and the HMAC keyed once, and
+    each URL's normalized form and base string prefix are cached, leaving
+    just the nonce, timestamp and signature to work out per request.
+    """
+    max_urls = 1024
+
+    def __init__(self, consumer, token, version='1.0'):
+        self.token = token
+        key = '%s&%s' % (_oauth_escape(consumer.secret), _oauth_escape(token.secret))
+        self.hmac = hmac.new(key, digestmod=hashlib.sha1)
+        params = {
+            'oauth_consumer_key': consumer.key,
+            'oauth_token': token.key,
+            'oauth_version': version,
+            'oauth_signature_method': 'HMAC-SHA1',
+        }
+        if token.callback:
+            params['oauth_callback'] = token.callback
+        self.params = [(_oauth_escape(k), _oauth_escape(v)) for (k, v) in params.items()]
+        self.header = 'OAuth realm=""' + ''.join(
+            ', %s="%s"' % (k, urllib.quote(str(v), '~')) for (k, v) in sorted(params.items()))
+        self.urls = {}
+
+    def sign(self, method, url, params=None, nonce=None, timestamp=None):
+        """
+        Sign a request, returning `(normalized url, Authorization header)`.
+        """
+        if nonce is None:
+            nonce = '%08d' % random.randrange(10 ** 8)
+        if timestamp is None:
+            timestamp = int(time.time())
+        cached = self.urls.get((method, url))
+        if cached is None:
+            if len(self.urls) >= self.max_urls:
+                self.urls.clear()
+            normalized = _normalize_oauth_url(url)
+            prefix = '%s&%s&' % (_oauth_escape(method.upper()), _oauth_escape(normalized))
+            cached = self.urls[(method, url)] = (normalized, prefix)
+        normalized, prefix = cached
+        nonce, timestamp = _oauth_escape(nonce), _oauth_escape(timestamp)
+        pairs = self.params + [('oauth_nonce', nonce), ('oauth_timestamp', timestamp)]
+        if params:
+            pairs.extend((_oauth_escape(k), _oauth_escape(v)) for (k, v) in params.iteritems())
+        pairs.sort()
+        hashed = self.hmac.copy()
+        hashed.update(prefix + _oauth_escape('&'.join(['%s=%s' % pair for pair in pairs])))
+        signature = binascii.b2a_base64(hashed.digest())[:-1]
+        return normalized, '%s, oauth_nonce="%s", oauth_timestamp="%s", oauth_signature="%s"' % (
+            self.header, nonce, timestamp, urllib.quote(signature, '~'))
+
+def _oauth_escape(s):
+    """
+    Escape a string as `oauth.escape(oauth._utf8_str(s))` does.
+    """
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return urllib.quote(str(s), '~')
+
+def _normalize_oauth_url(url):
+    """
+    Rebuild a URL as ``scheme://host/path``, as
+    `oauth.OAuthRequest.get_normalized_http_url` does.
+    """
+    scheme, netloc, path = urlparse.urlparse(url)[:3]
+    if scheme == 'http' and netloc[-3:] == ':80':
+        netloc = netloc[:-3]
+    elif scheme == 'https' and netloc[-4:] == ':443':
+        netloc = netloc[:-4]
+    return '%s://%s%s' % (scheme, netloc, path)
+
+class _LRUCache(object):
+    """
+    A small dict-like least-recently-used cache.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def popitem(self):
+        """
+        Remove and return the least recently used `(key, value)` pair.
+        """
+        return self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+def _resample(points, bucket, agg):
+    """
+    Aggregate time-ordered `(timestamp, value)` pairs into buckets.
+    """
+    current = None
+    for (ts, value) in points:
+        key = math.floor(ts / bucket) * bucket
+        if key != current:
+            if current is not None:
+                yield current, _aggregate(agg, count, total, low, high, last)
+            current = key
+            count = total = 0
+            low = high = last = None
+        if value is None:
+            continue
+        count += 1
+        total += value
+        if low is None or value < low:
+            low = value
+        if high is None or value > high:
+            high = value
+        last = value
+    if current is not None:
+        yield current, _aggregate(agg, count, total, low, high, last)
+
+def _aggregate(agg, count, total, low, high, last):
+    if not count:
+        return None
+    if agg == 'mean':
+        return float(total) / count
+    return {'min': low, 'max': high, 'last': last}[agg]
+
+def _open_stream(method, url, body=None, headers=None, http=None, timeout=None):
+    """
+    Send a request over a fresh connection and return the unread response.
+
+    httplib2 always reads the whole body into memory, so streaming reads go
+    straight through httplib instead. That also means they don't go through
+    an `HttpPool`; see its docstring. The connection is still made the way
+    `http` (an `httplib2.Http`, or one with the defaults if it's not given
+    or is a pool) would make it: through its proxy, with its certificates,
+    and with `timeout` if it's given or else its own.
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if not isinstance(http, httplib2.Http):
+        http = _new_http()
+    proxy_info = http.proxy_info
+    if callable(proxy_info):
+        proxy_info = proxy_info(scheme)
+    if proxy_info is not None and not proxy_info.applies_to(netloc.split(':')[0]):
+        proxy_info = None
+    if timeout is None:
+        timeout = http.timeout
+    connection_types = getattr(http, 'connection_types', httplib2.SCHEME_TO_CONNECTION)
+    if scheme == 'https':
+        kwargs = {}
+        certs = list(http.certificates.iter(netloc))
+        if certs:
+            kwargs = {'key_file': certs[0][0], 'cert_file': certs[0][1],
+                      'key_password': certs[0][2]}
+        conn = connection_types['https'](
+            netloc, timeout=timeout, proxy_info=proxy_info, ca_certs=http.ca_certs,
+            disable_ssl_certificate_validation=http.disable_ssl_certificate_validation,
+            ssl_version=http.ssl_version, **kwargs)
+    else:
+        conn = connection_types['http'](netloc, timeout=timeout, proxy_info=proxy_info)
+    if query:
+        path = "%s?%s" % (path, query)
+    conn.request(method, path or '/', body, headers or {})
+    return conn.getresponse()
+
+def _decoded(resp):
+    """
+    Wrap a streamed response so a gzipped body is decompressed as it's read.
+    """
+    if (resp.getheader('content-encoding') or '').lower() == 'gzip':
+        return _GzipResponse(resp)
+    return resp
+
+class _GzipResponse(object):
+    """
+    An `httplib.HTTPResponse` whose gzipped body is decompressed as it's
+    read; everything but `read()` is passed through to the response.
+    """
+    def __init__(self, resp):
+        self.resp = resp
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = ''
+        self.done = False
+
+    def __getattr__(self, attr):
+        return getattr(self.resp, attr)
+
+    def read(self, size=-1):
+        if size < 0:
+            data, self.pending = self.pending, ''
+            return data + ''.join(iter(lambda: self.read(CHUNK_SIZE), ''))
+        while len(self.pending) < size and not self.done:
+            # Decompress no more than is wanted, so a small download can't
+            # balloon in memory.
+            compressed = self.decompressor.unconsumed_tail
+            if not compressed:
+                compressed = self.resp.read(CHUNK_SIZE)
+            if not compressed:
+                self.pending += self.decompressor.flush()
+                self.done = True
+            else:
+                self.pending += self.decompressor.decompress(
+                    compressed, size - len(self.pending))
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+def _iter_blocks(stream, chunk_size):
+    """
+    Read a file-like object `chunk_size` bytes at a time, yielding blocks
+    that end on a line boundary.
+    """
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk = pending + chunk
+        end = chunk.rfind('\n') + 1
+        pending = chunk[end:]
+        if end:
+            yield chunk[:end]
+    if pending:
+        yield pending
+
+def _iter_lines(stream, chunk_size):
+    """
+    Split a file-like object into lines, reading `chunk_size` bytes at a time.
+    """
+    for block in _iter_blocks(stream, chunk_size):
+        lines = block.split('\n')
+        last = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if last:
+            yield last
+
+def _block_to_array(numpy, block):
+    """
+    Parse a block of CSV lines into a flat float64 array of alternating
+    timestamps and values, with NaN for nulls.
+    """
+    if not block.endswith('\n'):
+        block += '\n'
+    text = block.lower().replace('null', 'nan').replace('true', '1').replace('false', '0')
+    array = numpy.fromstring(text.replace('\n', ','), sep=',')
+    if len(array) != 2 * block.count('\n'):
+        # Blank lines, quoting or something else fromstring can't cope with;
+        # take the slow road.
+        rows = [
+            (float(ts), _valueish(val))
+            for (ts, val) in csv.reader(StringIO(block))
+        ]
+        array = numpy.array(
+            [(ts, val is None and numpy.nan or float(val)) for (ts, val) in rows],
+            dtype=numpy.float64
+        ).reshape(-1)
+    return array
+
+def _valueish(val):
+    """
+    Try to convert something Timetric sent back to a Python value.
+    """
+    v = val.lower()
+    if v in _LITERALS:
+        return _LITERALS[v]
+    return float(v)
+
+_LITERALS = {"null":None, "true":True, "false":False}
+
+#
+# The following code is adapted from Django (django.test.client)
+#
+BOUNDARY = 'tHiSiStHeBoUnDaRyStRiNg'
+MULTIPART_CONTENT = 'multipart/form-data; boundary=%s' % BOUNDARY
+
+# Kind ghetto, but works.
+def _is_file(thing): 
+    return hasattr(thing, "read") and callable(thing.read)
+
+def _encode_multipart(data, files):
+    """
+    Encodes multipart POST data from a dictionary of form values.
+
+    Returns a `MultipartStream`; file contents are read from the files as the
+    body is sent rather than up front.
+    """
+    return MultipartStream(data, files)
+
+class BodyStream(object):
+    """
+    A read-only file-like request body made of strings and files.
+
+    Files are only read, `CHUNK_SIZE` bytes at a time, as the body itself is
+    read, and `len()` gives the full Content-Length without reading
+    anything. Once a read has come back empty at the end of the body, the
+    next starts again from the beginning, so something that resends the
+    body by reading it again (as httplib2 does on a stale keep-alive
+    connection) sends all of it.
+
+    A client's own connections don't read the body at all but call
+    `send_to()`, which hands on-disk files to the socket straight from a
+    memory map, `MMAP_WINDOW` bytes at a time; so uploading even a huge file
+    never copies it into Python strings, and memory use stays flat.
+    """
+    def __init__(self, parts):
+        self.parts = []
+        self.length = 0
+        for part in parts:
+            if isinstance(part, str):
+                self.length += len(part)
+            else:
+                file, size = _sized_file(part)
+                part = (file, size, file.tell())
+                self.length += size
+            self.parts.append(part)
+        self.rewind()
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        """
+        Go back to the start of the body, so it can be sent again.
+        """
+        self._chunks = self._iter_chunks()
+        self._chunk = ''
+        self._offset = 0
+        self._ended = False
+
+    def __iter__(self):
+        return self._chunks
+
+    def _iter_chunks(self):
+        for part in self.parts:
+            if isinstance(part, str):
+                yield part
+            else:
+                for chunk in _read_file(*part):
+                    yield chunk
+
+    def read(self, size=-1):
+        """
+        Read up to `size` bytes of the body (all of it if `size` is negative).
+        """
+        if self._ended:
+            self.rewind()
+        if size < 0:
+            data = self._chunk[self._offset:] + ''.join(self._chunks)
+            self._chunk, self._offset = '', 0
+            self._ended = not data
+            return data
+        buf = []
+        while size > 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = ''
+                    break
+            piece = self._chunk[self._offset:self._offset + size]
+            self._offset += len(piece)
+            size -= len(piece)
+            buf.append(piece)
+        data = ''.join(buf)
+        self._ended = size > 0 and not data
+        return data
+
+    def send_to(self, sock):
+        """
+        Send the whole body, from the start, down a socket.
+        """
+        for part in self.parts:
+            if isinstance(part, str):
+                sock.sendall(part)
+            elif not _send_mapped(sock, *part):
+                for chunk in _read_file(*part):
+                    sock.sendall(chunk)
+
+class MultipartStream(BodyStream):
+    """
+    A multipart/form-data `BodyStream`. The headers and form values are
+    encoded up front; the files are sent as the body is.
+    """
+    def __init__(self, data, files):
+        parts = []
+        for (key, value) in data.items():
+            parts.append('\r\n'.join([
+                '--' + BOUNDARY,
+                'Content-Disposition: form-data; name="%s"' % str(key),
+                '',
+                str(value),
+                ''
+            ]))
+        for (key, value) in files.items():
+            parts.append('\r\n'.join([
+                '--' + BOUNDARY,
+                'Content-Disposition: form-data; name="%s"; filename="%s"' \
+                    % (str(key), str(key)),
+                'Content-Type: application/octet-stream',
+                '',
+                ''
+            ]))
+            parts.append(value)
+            parts.append('\r\n')
+        parts.append('--' + BOUNDARY + '--\r\n')
+        BodyStream.__init__(self, parts)
+
+def _gzip_body(body, level):
+    """
+    Gzip a `BodyStream` a chunk at a time, into a new `BodyStream`. The
+    compressed body is kept in memory up to `SPOOL_SIZE`, then spills to
+    disk.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in iter(lambda: body.read(CHUNK_SIZE), ''):
+        spool.write(compressor.compress(chunk))
+    spool.write(compressor.flush())
+    spool.seek(0)
+    return BodyStream([spool])
+
+def _read_file(file, size, start):
+    """
+    Yield `size` bytes of `file` from `start`, `CHUNK_SIZE` bytes at a time.
+    """
+    file.seek(start)
+    while size > 0:
+        chunk = file.read(min(CHUNK_SIZE, size))
+        if not chunk:
+            raise IOError("File changed size while being uploaded")
+        size -= len(chunk)
+        yield chunk
+
+def _send_mapped(sock, file, size, start):
+    """
+    Send `size` bytes of `file` from `start` down `sock` without reading
+    them, by memory-mapping the file a window at a time.
+
+    Returns False, having sent nothing, if the file isn't a regular on-disk
+    file that can be mapped.
+    """
+    fileno = _fileno(file)
+    if fileno is None or not size:
+        return False
+    try:
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            return False
+    except OSError:
+        return False
+    pos, end = start, start + size
+    while pos < end:
+        # Mappings have to start on a page boundary.
+        offset = pos - pos % mmap.ALLOCATIONGRANULARITY
+        length = min(MMAP_WINDOW, end - offset)
+        try:
+            window = mmap.mmap(fileno, length, access=mmap.ACCESS_READ, offset=offset)
+        except (EnvironmentError, ValueError):
+            if pos == start:
+                return False
+            raise IOError("File changed size while being uploaded")
+        try:
+            while pos < offset + length:
+                count = min(CHUNK_SIZE, offset + length - pos)
+                sock.sendall(buffer(window, pos - offset, count))
+                pos += count
+        finally:
+            window.close()
+    return True
+
+def _fileno(file):
+    """
+    Return the OS file descriptor behind a file-like object, or None.
+
+    Spooled temporary files that are still in memory are left there, rather
+    than being rolled over to disk to get a descriptor.
+    """
+    if isinstance(file, tempfile.SpooledTemporaryFile) and not file._rolled:
+        return None
+    try:
+        return file.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+def _sized_file(file):
+    """
+    Return `(file, bytes remaining)` for a file-like object.
+
+    Files that can't report their size (pipes, sockets, ...) are copied into
+    a spooled temporary file first.
+    """
+    fileno = _fileno(file)
+    if fileno is not None:
+        try:
+            return file, os.fstat(fileno).st_size - file.tell()
+        except (IOError, OSError, ValueError):
+            pass
+    try:
+        pos = file.tell()
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        file.seek(pos)
+        return file, end - pos
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        spool.write(chunk)
+    size = spool.tell()
+    spool.seek(0)
+    return spool, size